@@ -11,6 +11,8 @@ import shutil
 import os
 import imp
 import traceback
+import itertools
+import numpy
 
 from tomo_scan_lib import *
 import tomo_step_scan
@@ -62,37 +64,32 @@ def getVariableDict():
 
 def main():
     update_variable_dict(variableDict)
-    init_general_PVs(global_PVs, variableDict)
-    if variableDict.has_key('StopTheScan'):
-        stop_scan(global_PVs, variableDict)
+    # Connect the PVs once for all tiles, and share the same PV handles
+    # with tomo_step_scan
+    if not tomo_step_scan.setup_tomo_scan(variableDict):
         return
+    global_PVs.update(tomo_step_scan.global_PVs)
     FileName = global_PVs['HDF1_FileName'].get(as_string=True)
     FileTemplate = global_PVs['HDF1_FileTemplate'].get(as_string=True)
     global_PVs['HDF1_FileTemplate'].put('%s%s.h5')
-    if int(variableDict['Y_NumTiles']) <= 1:
-        y_itr = 0.0
-    else:
-        y_itr = ((float(variableDict['Y_Stop']) - float(variableDict['Y_Start'])) / (float(variableDict['Y_NumTiles']) - 1))
-    if int(variableDict['X_NumTiles']) <= 1:
-        x_itr = 0.0
-    else:
-        x_itr = ((float(variableDict['X_Stop']) - float(variableDict['X_Start'])) / (float(variableDict['X_NumTiles']) - 1))
-    y_val = float(variableDict['Y_Start'])
-    for y in range( int(variableDict['Y_NumTiles']) ):
-        x_val = float(variableDict['X_Start'])
-        global_PVs['Motor_SampleY'].put(y_val, wait=True, timeout=600.0)
-        #print 'sleep', float(variableDict['MosaicMoveSleep'])
-        #time.sleep(float(variableDict['MosaicMoveSleep']))
-        #wait_pv(global_PVs["Motor_Y_Tile"], y_val, 600)
-        y_val += y_itr
-        for x in range( int(variableDict['X_NumTiles']) ):
-            print( y_val, x_val)
-            global_PVs["Motor_SampleX"].put(x_val, wait=True, timeout=600.0)
-            print('sleep', float(variableDict['MosaicMoveSleep']))
-            time.sleep(float(variableDict['MosaicMoveSleep']))
-            #wait_pv(global_PVs["Motor_X_Tile"], x_val, 600)
-            x_val += x_itr
-            tomo_step_scan.full_tomo_scan(variableDict, FileName+'_y' + str(y) + '_x' + str(x) )
+    # Tile positions are computed directly so they don't drift across large grids
+    ys = numpy.linspace(float(variableDict['Y_Start']), float(variableDict['Y_Stop']), max(int(variableDict['Y_NumTiles']), 1))
+    xs = numpy.linspace(float(variableDict['X_Start']), float(variableDict['X_Stop']), max(int(variableDict['X_NumTiles']), 1))
+    last_y = None
+    for (y, y_val), (x, x_val) in itertools.product(enumerate(ys), enumerate(xs)):
+        print( y_val, x_val)
+        if y_val != last_y:
+            # Non-blocking so the Y move overlaps with the first X move of the row
+            global_PVs['Motor_SampleY'].put(y_val, use_complete=True)
+            last_y = y_val
+        global_PVs["Motor_SampleX"].put(x_val, use_complete=True)
+        if not wait_pvs_complete([global_PVs['Motor_SampleY'], global_PVs['Motor_SampleX']], 600.0):
+            # Don't scan (and mislabel) a tile the stage never reached
+            print('Sample motors did not reach', y_val, x_val, '- stopping the mosaic')
+            break
+        print('sleep', float(variableDict['MosaicMoveSleep']))
+        time.sleep(float(variableDict['MosaicMoveSleep']))
+        tomo_step_scan.full_tomo_scan(variableDict, FileName+'_y' + str(y) + '_x' + str(x), setup=False)
     global_PVs['HDF1_FileName'].put(FileName)
     global_PVs['HDF1_FileTemplate'].put('%s%s_%3.3d.h5')
 
@@ -7,12 +7,14 @@ from __future__ import print_function
 import sys
 import json
 import time
-from epics import PV
+import threading
+from epics import PV, poll
 import h5py
 import shutil
 import os
 import imp
 import traceback
+import numpy
 
 ShutterA_Open_Value = 0
 ShutterA_Close_Value = 1
@@ -59,47 +61,73 @@ def wait_pv(pv, wait_val, max_timeout_sec=-1):
 			return True
 
 
+#return an event that the pv's monitor sets each time it reaches wait_val,
+#and the callback index to pass to pv.remove_callback() when done
+def pv_event(pv, wait_val):
+	evt = threading.Event()
+	def on_change(value=None, **kw):
+		if value == wait_val:
+			evt.set()
+	cb_idx = pv.add_callback(on_change)
+	return evt, cb_idx
+
+
+#wait on pv's put with use_complete=True until all are done or max_timeout (default forever)
+def wait_pvs_complete(pvs, max_timeout_sec=-1):
+	print('wait_pvs_complete(', [pv.pvname for pv in pvs], max_timeout_sec, ')')
+	startTime = time.time()
+	while not all(pv.put_complete for pv in pvs):
+		if max_timeout_sec > -1:
+			diffTime = time.time() - startTime
+			if diffTime >= max_timeout_sec:
+				return False
+		poll(evt=1.e-3, iot=0.1)
+	return True
+
+
 def init_general_PVs(global_PVs, variableDict):
 	print('init_PVs()')
+	#config pv's are only put once per scan so they skip the CA monitor,
+	#status pv's that are waited on (acquire, capture, motors, shutters) keep theirs
 	#init detector pv's
-	global_PVs['Cam1_ImageMode'] = PV(variableDict['IOC_Prefix'] + 'cam1:ImageMode')
-	global_PVs['Cam1_ArrayCallbacks'] = PV(variableDict['IOC_Prefix'] + 'cam1:ArrayCallbacks')
-	global_PVs['Cam1_AcquirePeriod'] = PV(variableDict['IOC_Prefix'] + 'cam1:AcquirePeriod')
-	global_PVs['Cam1_TriggerMode'] = PV(variableDict['IOC_Prefix'] + 'cam1:TriggerMode')
-	global_PVs['Cam1_SoftwareTrigger'] = PV(variableDict['IOC_Prefix'] + 'cam1:SoftwareTrigger')
-	global_PVs['Cam1_AcquireTime'] = PV(variableDict['IOC_Prefix'] + 'cam1:AcquireTime')
-	global_PVs['Cam1_FrameRateOnOff'] = PV(variableDict['IOC_Prefix'] + 'cam1:FrameRateOnOff')
-	global_PVs['Cam1_FrameType'] = PV(variableDict['IOC_Prefix'] + 'cam1:FrameType')
-	global_PVs['Cam1_NumImages'] = PV(variableDict['IOC_Prefix'] + 'cam1:NumImages')
+	global_PVs['Cam1_ImageMode'] = PV(variableDict['IOC_Prefix'] + 'cam1:ImageMode', auto_monitor=False)
+	global_PVs['Cam1_ArrayCallbacks'] = PV(variableDict['IOC_Prefix'] + 'cam1:ArrayCallbacks', auto_monitor=False)
+	global_PVs['Cam1_AcquirePeriod'] = PV(variableDict['IOC_Prefix'] + 'cam1:AcquirePeriod', auto_monitor=False)
+	global_PVs['Cam1_TriggerMode'] = PV(variableDict['IOC_Prefix'] + 'cam1:TriggerMode', auto_monitor=False)
+	global_PVs['Cam1_SoftwareTrigger'] = PV(variableDict['IOC_Prefix'] + 'cam1:SoftwareTrigger', auto_monitor=False)
+	global_PVs['Cam1_AcquireTime'] = PV(variableDict['IOC_Prefix'] + 'cam1:AcquireTime', auto_monitor=False)
+	global_PVs['Cam1_FrameRateOnOff'] = PV(variableDict['IOC_Prefix'] + 'cam1:FrameRateOnOff', auto_monitor=False)
+	global_PVs['Cam1_FrameType'] = PV(variableDict['IOC_Prefix'] + 'cam1:FrameType', auto_monitor=False)
+	global_PVs['Cam1_NumImages'] = PV(variableDict['IOC_Prefix'] + 'cam1:NumImages', auto_monitor=False)
 	global_PVs['Cam1_Acquire'] = PV(variableDict['IOC_Prefix'] + 'cam1:Acquire')
 
 	#hdf5 writer pv's
-	global_PVs['HDF1_AutoSave'] = PV(variableDict['IOC_Prefix'] + 'HDF1:AutoSave')
-	global_PVs['HDF1_DeleteDriverFile'] = PV(variableDict['IOC_Prefix'] + 'HDF1:DeleteDriverFile')
-	global_PVs['HDF1_EnableCallbacks'] = PV(variableDict['IOC_Prefix'] + 'HDF1:EnableCallbacks')
-	global_PVs['HDF1_BlockingCallbacks'] = PV(variableDict['IOC_Prefix'] + 'HDF1:BlockingCallbacks')
-	global_PVs['HDF1_FileWriteMode'] = PV(variableDict['IOC_Prefix'] + 'HDF1:FileWriteMode')
-	global_PVs['HDF1_NumCapture'] = PV(variableDict['IOC_Prefix'] + 'HDF1:NumCapture')
+	global_PVs['HDF1_AutoSave'] = PV(variableDict['IOC_Prefix'] + 'HDF1:AutoSave', auto_monitor=False)
+	global_PVs['HDF1_DeleteDriverFile'] = PV(variableDict['IOC_Prefix'] + 'HDF1:DeleteDriverFile', auto_monitor=False)
+	global_PVs['HDF1_EnableCallbacks'] = PV(variableDict['IOC_Prefix'] + 'HDF1:EnableCallbacks', auto_monitor=False)
+	global_PVs['HDF1_BlockingCallbacks'] = PV(variableDict['IOC_Prefix'] + 'HDF1:BlockingCallbacks', auto_monitor=False)
+	global_PVs['HDF1_FileWriteMode'] = PV(variableDict['IOC_Prefix'] + 'HDF1:FileWriteMode', auto_monitor=False)
+	global_PVs['HDF1_NumCapture'] = PV(variableDict['IOC_Prefix'] + 'HDF1:NumCapture', auto_monitor=False)
 	global_PVs['HDF1_Capture'] = PV(variableDict['IOC_Prefix'] + 'HDF1:Capture')
 	global_PVs['HDF1_Capture_RBV'] = PV(variableDict['IOC_Prefix'] + 'HDF1:Capture_RBV')
-	global_PVs['HDF1_FileName'] = PV(variableDict['IOC_Prefix'] + 'HDF1:FileName')
+	global_PVs['HDF1_FileName'] = PV(variableDict['IOC_Prefix'] + 'HDF1:FileName', auto_monitor=False)
 	global_PVs['HDF1_FullFileName_RBV'] = PV(variableDict['IOC_Prefix'] + 'HDF1:FullFileName_RBV')
-	global_PVs['HDF1_FileTemplate'] = PV(variableDict['IOC_Prefix'] + 'HDF1:FileTemplate')
-	global_PVs['HDF1_ArrayPort'] = PV(variableDict['IOC_Prefix'] + 'HDF1:NDArrayPort')
+	global_PVs['HDF1_FileTemplate'] = PV(variableDict['IOC_Prefix'] + 'HDF1:FileTemplate', auto_monitor=False)
+	global_PVs['HDF1_ArrayPort'] = PV(variableDict['IOC_Prefix'] + 'HDF1:NDArrayPort', auto_monitor=False)
 
 	#tiff writer pv's
-	global_PVs['TIFF1_AutoSave'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:AutoSave')
-	global_PVs['TIFF1_DeleteDriverFile'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:DeleteDriverFile')
-	global_PVs['TIFF1_EnableCallbacks'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:EnableCallbacks')
-	global_PVs['TIFF1_BlockingCallbacks'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:BlockingCallbacks')
-	global_PVs['TIFF1_FileWriteMode'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileWriteMode')
-	global_PVs['TIFF1_NumCapture'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:NumCapture')
+	global_PVs['TIFF1_AutoSave'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:AutoSave', auto_monitor=False)
+	global_PVs['TIFF1_DeleteDriverFile'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:DeleteDriverFile', auto_monitor=False)
+	global_PVs['TIFF1_EnableCallbacks'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:EnableCallbacks', auto_monitor=False)
+	global_PVs['TIFF1_BlockingCallbacks'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:BlockingCallbacks', auto_monitor=False)
+	global_PVs['TIFF1_FileWriteMode'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileWriteMode', auto_monitor=False)
+	global_PVs['TIFF1_NumCapture'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:NumCapture', auto_monitor=False)
 	global_PVs['TIFF1_Capture'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:Capture')
 	global_PVs['TIFF1_Capture_RBV'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:Capture_RBV')
-	global_PVs['TIFF1_FileName'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileName')
+	global_PVs['TIFF1_FileName'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileName', auto_monitor=False)
 	global_PVs['TIFF1_FullFileName_RBV'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FullFileName_RBV')
-	global_PVs['TIFF1_FileTemplate'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileTemplate')
-	global_PVs['TIFF1_ArrayPort'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:NDArrayPort')
+	global_PVs['TIFF1_FileTemplate'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileTemplate', auto_monitor=False)
+	global_PVs['TIFF1_ArrayPort'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:NDArrayPort', auto_monitor=False)
 
 #	#motor pv's station A
 #	global_PVs['Motor_SampleX'] = PV('2bma:m48.VAL')
@@ -118,11 +146,11 @@ def init_general_PVs(global_PVs, variableDict):
 	global_PVs['Motor_pico90'] = PV('2bmb:m77.VAL')
 	
 	#shutter pv's
-	global_PVs['ShutterA_Open'] = PV('2bma:A_shutter:open.VAL')
-	global_PVs['ShutterA_Close'] = PV('2bma:A_shutter:close.VAL')
+	global_PVs['ShutterA_Open'] = PV('2bma:A_shutter:open.VAL', auto_monitor=False)
+	global_PVs['ShutterA_Close'] = PV('2bma:A_shutter:close.VAL', auto_monitor=False)
 	global_PVs['ShutterA_Move_Status'] = PV('PA:02BM:STA_A_FES_OPEN_PL')
-	global_PVs['ShutterB_Open'] = PV('2bma:B_shutter:open.VAL')
-	global_PVs['ShutterB_Close'] = PV('2bma:B_shutter:close.VAL')
+	global_PVs['ShutterB_Open'] = PV('2bma:B_shutter:open.VAL', auto_monitor=False)
+	global_PVs['ShutterB_Close'] = PV('2bma:B_shutter:close.VAL', auto_monitor=False)
 	global_PVs['ShutterB_Move_Status'] = PV('PA:02BM:STA_B_SBS_OPEN_PL')
 
 #	#fly macro
@@ -142,7 +170,7 @@ def init_general_PVs(global_PVs, variableDict):
 #	global_PVs['Theta_Cnt'] = PV('32idcTXM:SG_RdCntr:aSub.VALB')
 
 	#init misc pv's
-	global_PVs['Image1_Callbacks'] = PV(variableDict['IOC_Prefix'] + 'image1:EnableCallbacks')
+	global_PVs['Image1_Callbacks'] = PV(variableDict['IOC_Prefix'] + 'image1:EnableCallbacks', auto_monitor=False)
 #	global_PVs['ExternShutterExposure'] = PV('32idcTXM:shutCam:tExpose')
 #	global_PVs['SetSoftGlueForStep'] = PV('32idcTXM:SG3:MUX2-1_SEL_Signal')
 	#global_PVs['ClearTheta'] = PV('32idcTXM:recPV:PV1_clear')
@@ -158,27 +186,27 @@ def init_general_PVs(global_PVs, variableDict):
 #	global_PVs['Interferometer_Acquire'] = PV('32idcTXM:userAve4_acquire.PROC')
 
 	#init proc1 pv's
-	global_PVs['Proc1_Callbacks'] = PV(variableDict['IOC_Prefix'] + 'Proc1:EnableCallbacks')
-	global_PVs['Proc1_ArrayPort'] = PV(variableDict['IOC_Prefix'] + 'Proc1:NDArrayPort')
-	global_PVs['Proc1_Filter_Enable'] = PV(variableDict['IOC_Prefix'] + 'Proc1:EnableFilter')
-	global_PVs['Proc1_Filter_Type'] = PV(variableDict['IOC_Prefix'] + 'Proc1:FilterType')
-	global_PVs['Proc1_Num_Filter'] = PV(variableDict['IOC_Prefix'] + 'Proc1:NumFilter')
-	global_PVs['Proc1_Reset_Filter'] = PV(variableDict['IOC_Prefix'] + 'Proc1:ResetFilter')
-	global_PVs['Proc1_AutoReset_Filter'] = PV(variableDict['IOC_Prefix'] + 'Proc1:AutoResetFilter')
-	global_PVs['Proc1_Filter_Callbacks'] = PV(variableDict['IOC_Prefix'] + 'Proc1:FilterCallbacks')
+	global_PVs['Proc1_Callbacks'] = PV(variableDict['IOC_Prefix'] + 'Proc1:EnableCallbacks', auto_monitor=False)
+	global_PVs['Proc1_ArrayPort'] = PV(variableDict['IOC_Prefix'] + 'Proc1:NDArrayPort', auto_monitor=False)
+	global_PVs['Proc1_Filter_Enable'] = PV(variableDict['IOC_Prefix'] + 'Proc1:EnableFilter', auto_monitor=False)
+	global_PVs['Proc1_Filter_Type'] = PV(variableDict['IOC_Prefix'] + 'Proc1:FilterType', auto_monitor=False)
+	global_PVs['Proc1_Num_Filter'] = PV(variableDict['IOC_Prefix'] + 'Proc1:NumFilter', auto_monitor=False)
+	global_PVs['Proc1_Reset_Filter'] = PV(variableDict['IOC_Prefix'] + 'Proc1:ResetFilter', auto_monitor=False)
+	global_PVs['Proc1_AutoReset_Filter'] = PV(variableDict['IOC_Prefix'] + 'Proc1:AutoResetFilter', auto_monitor=False)
+	global_PVs['Proc1_Filter_Callbacks'] = PV(variableDict['IOC_Prefix'] + 'Proc1:FilterCallbacks', auto_monitor=False)
 
 	#tiff writer pv's
-	global_PVs['TIFF1_AutoSave'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:AutoSave')
-	global_PVs['TIFF1_DeleteDriverFile'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:DeleteDriverFile')
-	global_PVs['TIFF1_EnableCallbacks'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:EnableCallbacks')
-	global_PVs['TIFF1_BlockingCallbacks'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:BlockingCallbacks')
-	global_PVs['TIFF1_FileWriteMode'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileWriteMode')
-	global_PVs['TIFF1_NumCapture'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:NumCapture')
+	global_PVs['TIFF1_AutoSave'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:AutoSave', auto_monitor=False)
+	global_PVs['TIFF1_DeleteDriverFile'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:DeleteDriverFile', auto_monitor=False)
+	global_PVs['TIFF1_EnableCallbacks'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:EnableCallbacks', auto_monitor=False)
+	global_PVs['TIFF1_BlockingCallbacks'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:BlockingCallbacks', auto_monitor=False)
+	global_PVs['TIFF1_FileWriteMode'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileWriteMode', auto_monitor=False)
+	global_PVs['TIFF1_NumCapture'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:NumCapture', auto_monitor=False)
 	global_PVs['TIFF1_Capture'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:Capture')
 	global_PVs['TIFF1_FullFileName_RBV'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FullFileName_RBV')
-	global_PVs['TIFF1_FileNumber'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileNumber')
-	global_PVs['TIFF1_FileName'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileName')
-	global_PVs['TIFF1_ArrayPort'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:NDArrayPort')
+	global_PVs['TIFF1_FileNumber'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileNumber', auto_monitor=False)
+	global_PVs['TIFF1_FileName'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:FileName', auto_monitor=False)
+	global_PVs['TIFF1_ArrayPort'] = PV(variableDict['IOC_Prefix'] + 'TIFF1:NDArrayPort', auto_monitor=False)
 	
 	#energy
 #	global_PVs['DCMmvt'] = PV('32ida:KohzuModeBO.VAL')
@@ -196,6 +224,13 @@ def init_general_PVs(global_PVs, variableDict):
 #	global_PVs['Interlaced_Num_Sub_Cycles'] = PV('32idcTXM:iFly:interlaceFlySub.B')
 #	global_PVs['Interlaced_Num_Sub_Cycles_RBV'] = PV('32idcTXM:iFly:interlaceFlySub.VALG')
 
+	#the searches above all run at once, so wait for them here against one
+	#shared deadline instead of on each pv's first put/get during the scan
+	deadline = time.time() + 5.0
+	for pv in global_PVs.values():
+		if not pv.wait_for_connection(timeout=max(deadline - time.time(), 0.01)):
+			print('PV not connected:', pv.pvname)
+
 def stop_scan(global_PVs, variableDict):
 	global_PVs['TIFF1_AutoSave'].put('No')
 	global_PVs['TIFF1_Capture'].put(0)
@@ -399,13 +434,14 @@ def add_extra_hdf5(global_PVs, variableDict, theta_arr, interf_arrs):
 	try:
 		print('Opening hdf5 file ',fullname)
 		hdf_f = h5py.File(fullname, mode='a')
-		theta_ds = hdf_f.create_dataset('/exchange/theta', (len(theta_arr),))
-		theta_ds[:] = theta_arr[:]
+		hdf_f.create_dataset('/exchange/theta', data=numpy.asarray(theta_arr), dtype='f')
 		if variableDict.has_key('UseInterferometer') and int(variableDict['UseInterferometer']) > 0:
-			interf_ds = hdf_f.create_dataset('/exchange/interferometer', (len(interf_arrs), len(interf_arrs[0])), dtype='f' )
+			#build the whole block in memory so it goes out in a single write
+			interf_block = numpy.zeros((len(interf_arrs), len(interf_arrs[0])), dtype='f')
 			for i in range(len(interf_arrs)):
 				if len(interf_arrs[i]) == len(interf_arrs[0]):
-					interf_ds[i,:] = interf_arrs[i][:]
+					interf_block[i,:] = interf_arrs[i][:]
+			hdf_f.create_dataset('/exchange/interferometer', data=interf_block)
 		hdf_f.close()
 	except:
 		traceback.print_exc(file=sys.stdout)
@@ -61,93 +61,140 @@ def getVariableDict():
 
 def gen_interlaced_theta():
 	#set num cycles to 1 so we only do 1 scan
-	global_PVs['Interlaced_Num_Cycles'].put(1, wait=True)
-	global_PVs['Interlaced_Images_Per_Cycle'].put(int(variableDict['Projections']), wait=True)
+	global_PVs['Interlaced_Num_Cycles'].put(1, use_complete=True)
+	global_PVs['Interlaced_Images_Per_Cycle'].put(int(variableDict['Projections']), use_complete=True)
 	#global_PVs['Interlaced_Images_Per_Cycle_RBV']
-	global_PVs['Interlaced_Num_Sub_Cycles'].put(int(variableDict['Interlaced_Sub_Cycles']), wait=True)
+	global_PVs['Interlaced_Num_Sub_Cycles'].put(int(variableDict['Interlaced_Sub_Cycles']), use_complete=True)
 	#global_PVs['Interlaced_Num_Revs_RBV']
+	#the three settings are independent, wait on them together before proc
+	if not wait_pvs_complete([global_PVs['Interlaced_Num_Cycles'], global_PVs['Interlaced_Images_Per_Cycle'], global_PVs['Interlaced_Num_Sub_Cycles']], 10.0):
+		#don't scan with a theta array built from stale settings
+		print('Timed out setting up the interlaced scan')
+		raise RuntimeError('Interlaced scan settings did not complete')
 	#proc
 	global_PVs['Interlaced_PROC'].put(1, wait=True)
 	theta_arr = global_PVs['Interlaced_Theta_Arr'].get(int(variableDict['Projections']))
 	return theta_arr
 
 def update_theta_for_more_proj(orig_theta):
-	new_theta = []
-	for val in orig_theta:
-		for j in range( int(variableDict['ProjectionsPerRot']) ):
-			new_theta += [val]
-	return new_theta
+	return numpy.repeat(numpy.asarray(orig_theta, dtype=numpy.float64), int(variableDict['ProjectionsPerRot']))
 
 def tomo_scan(global_PVs, variableDict):
 	print('tomo_scan()')
 	theta = []
 	interf_arr = []
-	if variableDict.has_key('UseInterferometer') and int(variableDict['UseInterferometer']) > 0:
+	use_interferometer = 'UseInterferometer' in variableDict and int(variableDict['UseInterferometer']) > 0
+	rec_enabled = 'Recursive_Filter_Enabled' in variableDict and variableDict['Recursive_Filter_Enabled'] == 1
+	if use_interferometer:
 		global_PVs['Interferometer_Mode'].put('ONE-SHOT')
-	step_size = ((float(variableDict['SampleEnd_Rot']) - float(variableDict['SampleStart_Rot'])) / (float(variableDict['Projections']) - 1.0))
-	if variableDict.has_key('Interlaced') and int(variableDict['Interlaced']) > 0:
+	if 'Interlaced' in variableDict and int(variableDict['Interlaced']) > 0:
 		theta = gen_interlaced_theta()
 	else:
-		theta = numpy.arange(float(variableDict['SampleStart_Rot']), float(variableDict['SampleEnd_Rot'])+1, step_size)
+		theta = numpy.linspace(float(variableDict['SampleStart_Rot']), float(variableDict['SampleEnd_Rot']), int(variableDict['Projections']), dtype=numpy.float64)
+	if use_interferometer:
+		interf_arr = numpy.empty(len(theta), dtype=numpy.float64)
+		interf_val = global_PVs['Interferometer_Val']
+		interf_acq = global_PVs['Interferometer_Acquire']
 	#end_pos = float(variableDict['SampleEnd_Rot'])
 	global_PVs['Cam1_FrameType'].put(FrameTypeData, wait=True)
-	global_PVs['Cam1_NumImages'].put(1, wait=True)
+	# with internal triggering the camera takes the recursive filter frames
+	# in a single acquire, otherwise each frame needs its own software trigger
+	rec_n = int(variableDict.get('Recursive_Filter_N_Images', 1))
+	rec_burst = rec_enabled and PG_Trigger_External_Trigger != 1
+	if rec_burst:
+		global_PVs['Cam1_ImageMode'].put('Multiple', wait=True)
+		global_PVs['Cam1_NumImages'].put(rec_n, wait=True)
+	else:
+		global_PVs['Cam1_NumImages'].put(1, wait=True)
 	#if int(variableDict['ExternalShutter']) == 1:
 	#	global_PVs['Cam1_TriggerMode'].put('Ext. Standard', wait=True)
 	#sample_rot = float(variableDict['SampleStart_Rot'])
-	if variableDict.has_key('Recursive_Filter_Enabled') and  variableDict['Recursive_Filter_Enabled'] == 1:
+	if rec_enabled:
 		global_PVs['Proc1_Filter_Enable'].put('Enable')
+	motor_rot = global_PVs['Motor_SampleRot']
+	cam_acq = global_PVs['Cam1_Acquire']
+	cam_trig = global_PVs['Cam1_SoftwareTrigger']
+	proc_cb = global_PVs['Proc1_Callbacks']
+	# set from the Cam1_Acquire monitor, clear it before each acquire
+	acq_idle, acq_cb = pv_event(cam_acq, DetectorIdle)
+	stab_sleep_s = float(variableDict['StabilizeSleep_ms']) / 1000.0
+	ppr = int(variableDict['ProjectionsPerRot'])
+	# one acquire takes a single frame, or all rec_n frames of a burst
+	acq_timeout = 60
+	if rec_burst:
+		frame_s = float(variableDict['ExposureTime']) + float(variableDict.get('CCD_Readout', 0.27))
+		acq_timeout += rec_n * frame_s
 #	sample_x = 0.0
 #	delsx = -2.09 * 1.800 / len(theta)
-	for sample_rot in theta:
+	for i, sample_rot in enumerate(theta):
 	#for i in range(int(variableDict['Projections'])):
 	#while sample_rot <= end_pos:
 		print('Sample Rot:', sample_rot)
 		#print 'Sample X:', sample_x
-		global_PVs['Motor_SampleRot'].put(sample_rot, wait=True)
+		if PG_Trigger_External_Trigger == 1:
+			# camera waits for the software trigger, so arm it while the stage moves
+			motor_rot.put(sample_rot, use_complete=True)
+			acq_idle.clear()
+			cam_acq.put(DetectorAcquire)
+			if not wait_pvs_complete([motor_rot], 600.0):
+				print('Timed out waiting for rotation to', sample_rot)
+			wait_pv(cam_acq, DetectorAcquire, 2)
+			armed = True
+		else:
+			motor_rot.put(sample_rot, wait=True)
+			armed = False
 #		global_PVs['Motor_SampleX'].put(sample_x)
 #		sample_x += delsx
-		if variableDict.has_key('UseInterferometer') and int(variableDict['UseInterferometer']) > 0:
-			global_PVs['Interferometer_Acquire'].put(1)
-			interf_arr += [global_PVs['Interferometer_Val'].get()]
+		if use_interferometer:
+			interf_acq.put(1)
+			interf_arr[i] = interf_val.get()
 		print('Stabilize Sleep (ms)', variableDict['StabilizeSleep_ms'])
-		time.sleep(float(variableDict['StabilizeSleep_ms']) / 1000.0)
+		time.sleep(stab_sleep_s)
 		# save theta to array
 		#theta += [sample_rot]
 		# start detector acquire
-		if variableDict.has_key('Recursive_Filter_Enabled') and  variableDict['Recursive_Filter_Enabled'] == 1:
-			global_PVs['Proc1_Callbacks'].put('Enable', wait=True)
-			for k in range(int(variableDict['Recursive_Filter_N_Images'])):
-				global_PVs['Cam1_Acquire'].put(DetectorAcquire)
-				wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2)
-				global_PVs['Cam1_SoftwareTrigger'].put(1)
-				wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, 60)
-		elif variableDict['ProjectionsPerRot'] > 1:
-			for j in range( int(variableDict['ProjectionsPerRot']) ):
-				global_PVs['Cam1_Acquire'].put(DetectorAcquire)
-				wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2)
-				global_PVs['Cam1_SoftwareTrigger'].put(1)
-				wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, 60)
+		if rec_enabled:
+			proc_cb.put('Enable', wait=True)
+		if rec_enabled and not rec_burst:
+			for k in range(rec_n):
+				if k > 0 or not armed:
+					acq_idle.clear()
+					cam_acq.put(DetectorAcquire)
+					wait_pv(cam_acq, DetectorAcquire, 2)
+				cam_trig.put(1)
+				acq_idle.wait(60)
+		elif ppr > 1 and not rec_enabled:
+			for j in range(ppr):
+				if j > 0 or not armed:
+					acq_idle.clear()
+					cam_acq.put(DetectorAcquire)
+					wait_pv(cam_acq, DetectorAcquire, 2)
+				cam_trig.put(1)
+				acq_idle.wait(60)
 		else:
-			global_PVs['Cam1_Acquire'].put(DetectorAcquire)
-			wait_pv(global_PVs['Cam1_Acquire'], DetectorAcquire, 2)
-			global_PVs['Cam1_SoftwareTrigger'].put(1)
+			if not armed:
+				acq_idle.clear()
+				cam_acq.put(DetectorAcquire)
+				wait_pv(cam_acq, DetectorAcquire, 2)
+			cam_trig.put(1)
 		# if external shutter
 		#if int(variableDict['ExternalShutter']) == 1:
 		#	print 'External trigger'
 		#	#time.sleep(float(variableDict['rest_time']))
 		#	global_PVs['ExternalShutter_Trigger'].put(1, wait=True)
 		# wait for acquire to finish
-		wait_pv(global_PVs['Cam1_Acquire'], DetectorIdle, 60)
+		if not acq_idle.wait(acq_timeout):
+			print('Timed out waiting for the detector at', sample_rot)
 		# update sample rotation
 		#sample_rot += step_size
 	# set trigger move to internal for post dark and white
 	#global_PVs['Cam1_TriggerMode'].put('Internal', wait=True)
 	#if int(variableDict['ExternalShutter']) == 1:
 	#	global_PVs['SetSoftGlueForStep'].put('0')
-	if variableDict.has_key('Recursive_Filter_Enabled') and variableDict['Recursive_Filter_Enabled'] == 1:
+	cam_acq.remove_callback(acq_cb)
+	if rec_enabled:
 		global_PVs['Proc1_Filter_Enable'].put('Disable', wait=True)
-	if variableDict['ProjectionsPerRot'] > 1:
+	if ppr > 1:
 		theta = update_theta_for_more_proj(theta)
 	return theta, interf_arr
 
@@ -155,17 +202,19 @@ def mirror_fly_scan(rev=False):
 	print('mirror_fly_scan()')
 	interf_arr = []
 	global_PVs['Interferometer_Reset'].put(1, wait=True)
-	time.sleep(2.0)
-	# setup fly scan macro
-	delta = ((float(variableDict['SampleEnd_Rot']) - float(variableDict['SampleStart_Rot'])) / (	float(variableDict['Projections'])))
+	# reset clears the readout counter, wait for it rather than a fixed sleep
+	wait_pv(global_PVs['Interferometer_Cnt'], 0, 5)
+	# setup fly scan macro, read the scan range once
+	start = float(variableDict['SampleStart_Rot'])
+	end = float(variableDict['SampleEnd_Rot'])
+	delta = (end - start) / float(variableDict['Projections'])
 	slew_speed = 60
-	global_PVs['Fly_ScanDelta'].put(delta)
 	if rev:
-		global_PVs['Fly_StartPos'].put(float(variableDict['SampleEnd_Rot']))
-		global_PVs['Fly_EndPos'].put(float(variableDict['SampleStart_Rot']))
-	else:
-		global_PVs['Fly_StartPos'].put(float(variableDict['SampleStart_Rot']))
-		global_PVs['Fly_EndPos'].put(float(variableDict['SampleEnd_Rot']))
+		start, end = end, start
+	# no-wait puts, the Fly_Taxi put below goes out after them
+	global_PVs['Fly_ScanDelta'].put(delta)
+	global_PVs['Fly_StartPos'].put(start)
+	global_PVs['Fly_EndPos'].put(end)
 	global_PVs['Fly_SlewSpeed'].put(slew_speed)
 	# num_images = ((float(variableDict['SampleEnd_Rot']) - float(variableDict['SampleStart_Rot'])) / (delta + 1.0))
 	#num_images = int(variableDict['Projections'])
@@ -175,28 +224,38 @@ def mirror_fly_scan(rev=False):
 	print('Fly')
 	global_PVs['Fly_Run'].put(1, wait=True)
 	wait_pv(global_PVs['Fly_Run'], 0)
-	global_PVs['Interferometer_Proc_Arr'].put(1)
-	time.sleep(2.0)
+	# put callback returns once the array record has processed
+	global_PVs['Interferometer_Proc_Arr'].put(1, wait=True, timeout=5)
 	interf_cnt = global_PVs['Interferometer_Cnt'].get()
 	interf_arr = global_PVs['Interferometer_Arr'].get(count=interf_cnt)
 	# wait for acquire to finish
 	return interf_arr
 
 
-def full_tomo_scan(variableDict, detector_filename):
-	print('start_scan()')
+#connect pv's, returns False if the scan was stopped
+#call once before a series of full_tomo_scan(..., setup=False), e.g. mosaic tiles
+def setup_tomo_scan(variableDict):
+	print('setup_tomo_scan()')
 	init_general_PVs(global_PVs, variableDict)
-	if variableDict.has_key('StopTheScan'):
+	if 'StopTheScan' in variableDict:
 		stop_scan(global_PVs, variableDict)
+		return False
+	return True
+
+def full_tomo_scan(variableDict, detector_filename, setup=True):
+	print('start_scan()')
+	if setup and not setup_tomo_scan(variableDict):
 		return
 	#collect interferometer
 	interf_arrs = []
-	if variableDict.has_key('UseInterferometer') and int(variableDict['UseInterferometer']) > 0:
+	if 'UseInterferometer' in variableDict and int(variableDict['UseInterferometer']) > 0:
 		for i in range(2):
-			interf_arrs += [mirror_fly_scan()]
-			interf_arrs += [mirror_fly_scan(rev=True)]
+			interf_arrs.append(mirror_fly_scan())
+			interf_arrs.append(mirror_fly_scan(rev=True))
 	# Start scan sleep in min so min * 60 = sec
 	time.sleep(float(variableDict['StartSleep_min']) * 60.0)
+	# every tile gets a freshly configured detector, tomo_scan may have
+	# left it in a recursive filter burst (NumImages > 1)
 	setup_detector(global_PVs, variableDict)
 	setup_writer(global_PVs, variableDict, detector_filename)
 	if int(variableDict['PreDarkImages']) > 0:
@@ -8,6 +8,8 @@ acquired. The script calls the move_energy method from the TXM class.
 
 import time
 import os
+import sys
+import threading
 import logging
 import warnings
 
@@ -15,7 +17,7 @@ import numpy as np
 import h5py
 import tqdm
 from scanlib.scan_variables import update_variable_dict, parse_list_variable
-from scanlib.tools import energy_range_from_points, loggingConfig
+from scanlib.tools import energy_range_from_points, loggingConfig, start_sleep
 from aps_32id.txm import new_txm
 
 __author__ = 'Mark Wolfman'
@@ -47,6 +49,9 @@ variableDict = {
     'Repetitions': 1,
     'Pause': 0, # in minutes
     'Use_Fast_Shutter': 1,
+    'Wait_For_Energy': 0, # 1 = end stabilization early once the undulator is idle
+    'Two_Pass': 0, # 1 = all sample frames first, then all white-fields
+    'Compression': None,
     # Logging: 0=UNSET, 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
     'Log_Level': logging.INFO,
 }
@@ -55,13 +60,62 @@ SHUTTER_PERMIT = False
 
 log = logging.getLogger(__name__)
 
+# Logged for every frame in the energy loop
+ACQUIRE_MSG = "Acquiring %s position %s at %.4f keV"
+# Zone plate X moves smaller than this (in mm) are skipped
+ZP_X_TOLERANCE = 1e-4
+# How long (in sec) to let the HDF writer finish on its own
+HDF_DRAIN_TIMEOUT = 30
+
 
 def getVariableDict():
     return variableDict
 
 
+def _progress(iterable, desc, **kwargs):
+    """Wrap ``iterable`` in a tqdm progress bar that redraws at most
+    once a second, and not at all when stderr is not a terminal."""
+    return tqdm.tqdm(iterable, desc=desc, mininterval=1.0, miniters=1,
+                     smoothing=0.1, leave=True,
+                     disable=not sys.stderr.isatty(), **kwargs)
+
+
+def _in_background(func, *args, **kwargs):
+    """Start ``func(*args, **kwargs)`` in a separate thread.
+    
+    Returns a function that waits for the thread to finish and
+    re-raises any exception it hit.
+    
+    """
+    errors = []
+    def target():
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    def join():
+        thread.join()
+        if errors:
+            raise errors[0]
+    return join
+
+
+def _move_zone_plate_x(txm, zp_x, tolerance=ZP_X_TOLERANCE):
+    """Move the zone plate in x unless it is already within
+    ``tolerance`` of ``zp_x``."""
+    # Compare the readback, the setpoint can differ if a move was
+    # aborted or the motor stalled
+    current = txm.zone_plate_x_RBV
+    if current is None or abs(current - zp_x) > tolerance:
+        txm.zone_plate_x = zp_x
+
+
 def _capture_energy_frames(txm, energies, constant_mag,
-                           stabilize_sleep_ms, sample_pos, out_pos, ZP_X_drift_array):
+                           stabilize_sleep_ms, sample_pos, out_pos, ZP_X_drift_array,
+                           wait_for_energy=False):
     """A helper method for collected a set of energy frames.
     
     The TXM should already be set up before calling this function.
@@ -85,43 +139,184 @@ def _capture_energy_frames(txm, energies, constant_mag,
     ZP_X_drift_array : np.ndarray
       Each entry is the change in x position of the zoneplate needed
       to keep the sample centered at that energy.
+    wait_for_energy : bool, optional
+      If true, stop waiting as soon as the undulator reports it is no
+      longer busy, with ``stabilize_sleep_ms`` as the upper
+      limit. Otherwise, always sleep for ``stabilize_sleep_ms``.
+
+    Returns
+    -------
+    frames : list
+      ``(energy, frame_type)`` for each frame, in the order they were
+      captured. ``frame_type`` is ``txm.FRAME_DATA`` or
+      ``txm.FRAME_WHITE``.
 
     """
     correct_backlash = True # First energy only
-    for idx, energy in enumerate(tqdm.tqdm(energies, "Energy scan")):
-        log.debug('Preparing to capture energy: %f keV', energy)
-        # Check whether we should collect the sample or white field first 
-        sample_first = not bool(idx % 2)
-        log.info("Collecting %s first.", "sample" if sample_first else "white-field")
+    # Convert to native floats once instead of boxing numpy scalars each step
+    energies = np.ascontiguousarray(energies, dtype=np.float64)
+    zp_x_positions = np.asarray(ZP_X_drift_array, dtype=np.float64)
+    # Alternate whether the sample or white field is collected first
+    # so that one motion is saved at each energy
+    sample_step = ("sample", sample_pos, txm.capture_projections, txm.FRAME_DATA)
+    white_step = ("white-field", out_pos, txm.capture_white_field, txm.FRAME_WHITE)
+    schedule = [(sample_step, white_step) if idx % 2 == 0 else (white_step, sample_step)
+                for idx in range(len(energies))]
+    stabilize_sleep_s = stabilize_sleep_ms / 1000.0
+    info_on = log.isEnabledFor(logging.INFO)
+    debug_on = log.isEnabledFor(logging.DEBUG)
+    energy_steps = zip(energies.tolist(), zp_x_positions.tolist())
+    frames = []
+    for idx, (energy, zp_x) in enumerate(_progress(energy_steps, "Energy scan",
+                                                   total=len(energies))):
+        if debug_on:
+            log.debug('Preparing to capture energy: %f keV', energy)
+        first_step, second_step = schedule[idx]
+        first_name, first_pos, capture_first, first_type = first_step
+        second_name, second_pos, capture_second, second_type = second_step
+        if info_on:
+            log.info("Collecting %s first.", first_name)
         # Move sample, zone plate and energy
-        txm.zone_plate_x = ZP_X_drift_array[idx]
-        if sample_first:
-            txm.move_sample(*sample_pos)
-        else:
-            txm.move_sample(*out_pos)
+        _move_zone_plate_x(txm, zp_x)
+        # The sample stage and the source optics are independent, so
+        # the sample moves while the energy is changing
+        wait_for_sample = _in_background(txm.move_sample, *first_pos)
         txm.move_energy(energy, constant_mag=constant_mag,
                         correct_backlash=correct_backlash)
+        # The beam starts stabilizing as soon as the energy is set,
+        # even if the sample is still moving
+        energy_done = time.time()
+        wait_for_sample()
         correct_backlash = False # Needed on first energy only
-        # Pause for a moment to allow the beam to stabilize
-        log.debug('Stabilize Sleep %f ms', stabilize_sleep_ms)
-        time.sleep(stabilize_sleep_ms / 1000.0)
-        # Sample projection acquisition (or white-field on odd passes)
-        if sample_first:
-            log.info("Acquiring sample position %s at %.4f eV", sample_pos, energy)
-            txm.capture_projections()
+        # Pause for whatever is left of the stabilization time
+        remaining_s = stabilize_sleep_s - (time.time() - energy_done)
+        if debug_on:
+            log.debug('Stabilize Sleep %f ms', max(remaining_s, 0) * 1000)
+        if remaining_s <= 0:
+            pass
+        elif wait_for_energy:
+            # Timing out just means the full stabilization time passed
+            txm.wait_pv('EnergyWait', 0, timeout=remaining_s, quiet=True)
         else:
-            log.info("Acquiring white-field position %s at %.4f eV", out_pos, energy)
-            txm.capture_white_field()
+            time.sleep(remaining_s)
+        # Sample projection acquisition (or white-field on odd passes)
+        if info_on:
+            log.info(ACQUIRE_MSG, first_name, first_pos, energy)
+        capture_first()
+        frames.append((energy, first_type))
         # Flat-field projection acquisition (or sample on odd passes)
-        if sample_first:
-            txm.move_sample(*out_pos)
-            log.info("Acquiring white-field position %s at %.4f eV", out_pos, energy)
-            # time.sleep(3)
-            txm.capture_white_field()
-        else:
-            txm.move_sample(*sample_pos)
-            log.info("Acquiring sample position %s at %.4f eV", sample_pos, energy)
-            txm.capture_projections()
+        txm.move_sample(*second_pos)
+        if info_on:
+            log.info(ACQUIRE_MSG, second_name, second_pos, energy)
+        capture_second()
+        frames.append((energy, second_type))
+    return frames
+
+
+def _capture_energy_passes(txm, energies, constant_mag,
+                           stabilize_sleep_ms, sample_pos, out_pos, ZP_X_drift_array,
+                           wait_for_energy=False):
+    """Collect energy frames in two passes instead of alternating.
+    
+    The sample is moved in once and projections are collected at
+    every energy, then it is moved out once and white-fields are
+    collected at the same energies. The sample stage moves twice in
+    total. Both passes go up in energy, with backlash correction at
+    the start of each, so the monochromator reaches every energy from
+    the same side for the sample and the white-field. Parameters and
+    return value are the same as for :py:func:`_capture_energy_frames`.
+    
+    """
+    energies = np.ascontiguousarray(energies, dtype=np.float64).tolist()
+    zp_x_positions = np.asarray(ZP_X_drift_array, dtype=np.float64).tolist()
+    stabilize_sleep_s = stabilize_sleep_ms / 1000.0
+    steps = list(zip(energies, zp_x_positions))
+    passes = [("sample", sample_pos, txm.capture_projections, txm.FRAME_DATA),
+              ("white-field", out_pos, txm.capture_white_field, txm.FRAME_WHITE)]
+    frames = []
+    for name, position, capture, frame_type in passes:
+        log.info("Collecting %s frames at %d energies", name, len(steps))
+        txm.move_sample(*position)
+        # The first energy of each pass is approached from above
+        correct_backlash = True
+        for energy, zp_x in _progress(steps, "Energy scan ({})".format(name)):
+            _move_zone_plate_x(txm, zp_x)
+            txm.move_energy(energy, constant_mag=constant_mag,
+                            correct_backlash=correct_backlash)
+            correct_backlash = False
+            # Pause for a moment to allow the beam to stabilize
+            if wait_for_energy:
+                txm.wait_pv('EnergyWait', 0, timeout=stabilize_sleep_s,
+                            quiet=True)
+            else:
+                time.sleep(stabilize_sleep_s)
+            capture()
+            frames.append((energy, frame_type))
+    return frames
+
+
+def _save_energies(txm, hdf_filename, energies, ZP_X_drift_array,
+                   frames=None):
+    """Add the energies and zone-plate drift to a finished HDF file.
+    
+    The file is owned by the areaDetector HDF writer while the scan is
+    running, so this opens it once after the writer is done and writes
+    each array in a single call.
+    
+    ``frames`` is an optional list of ``(energy, frame_type)`` for
+    every frame in the file. It is saved as ``/exchange/frame_energy``
+    and ``/exchange/frame_type`` so each frame can be matched to its
+    energy and field.
+    
+    """
+    # If the scan never wrote a file, don't wait on the HDF writer
+    has_file = (bool(hdf_filename) and os.path.exists(hdf_filename)
+                and os.path.getsize(hdf_filename) > 0)
+    saved = False
+    if has_file:
+        try:
+            with txm.hdf_file(hdf_filename, mode="r+") as hdf_f:
+                log.debug('Saving energies to file: %s', hdf_filename)
+                # Each array goes out in one contiguous, unfiltered write
+                extra_datasets = [('/exchange/energy', energies),
+                                  ('/exchange/zp_x_drift', ZP_X_drift_array)]
+                if frames is not None:
+                    frame_energy, frame_type = zip(*frames) if frames else ((), ())
+                    extra_datasets += [('/exchange/frame_energy', frame_energy),
+                                       ('/exchange/frame_type', frame_type)]
+                for ds_name, data in extra_datasets:
+                    # Replace anything left from an earlier attempt
+                    if ds_name in hdf_f:
+                        del hdf_f[ds_name]
+                    dtype = np.int8 if ds_name == '/exchange/frame_type' else np.float64
+                    hdf_f.create_dataset(ds_name, chunks=None, compression=None,
+                                         data=np.ascontiguousarray(data, dtype=dtype))
+            saved = True
+        except (OSError, IOError, KeyError) as e:
+            log.debug("Error saving energies: %s", e)
+    if saved:
+        _drop_page_cache(hdf_filename)
+    else:
+        # Could not load HDF file, so raise a warning
+        msg = "Could not save energies to file %s" % hdf_filename
+        warnings.warn(msg, RuntimeWarning)
+        log.warning(msg)
+
+
+def _drop_page_cache(filename):
+    """Tell the kernel the pages of a finished file won't be needed
+    again, so long sessions don't fill the page cache with old scans.
+    Does nothing on platforms without ``posix_fadvise``."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        log.debug("Could not drop page cache for %s: %s", filename, e)
 
 
 def run_energy_scan(energies, exposure=0.5, n_pre_dark=5,
@@ -131,6 +326,9 @@ def run_energy_scan(energies, exposure=0.5, n_pre_dark=5,
                     repetitions=1,
                     pause=0,
                     use_fast_shutter=True,
+                    wait_for_energy=False,
+                    two_pass=False,
+                    compression=None,
                     log_level=logging.INFO,
                     txm=None):
     """Collect a series of 2-dimensional projections across a range of energies.
@@ -172,6 +370,16 @@ def run_energy_scan(energies, exposure=0.5, n_pre_dark=5,
     use_fast_shutter : bool, optional
       Whether to open and shut the fast shutter before triggering
       projections.
+    wait_for_energy : bool, optional
+      If true, the stabilization wait ends as soon as the undulator is
+      no longer busy, with ``stabilize_sleep_ms`` as the upper limit.
+    two_pass : bool, optional
+      If true, collect all the sample frames first and then all the
+      white-fields, instead of collecting both at each energy. This
+      saves sample moves, but the frames end up in a different order
+      in the HDF file (see ``/exchange/frame_type``).
+    compression : str, optional
+      Passed on to :meth:`NanoTXM.setup_hdf_writer`.
     log_level : int, optional
       Temporary log level to use. ``None`` does not change the logging.
     txm : optional
@@ -181,14 +389,17 @@ def run_energy_scan(energies, exposure=0.5, n_pre_dark=5,
     """
     log.debug("Starting run_energy_scan()")
     start_time = time.time()
+    # Convert once so every repetition reuses the same float array
+    energies = np.ascontiguousarray(energies, dtype=np.float64)
     total_projections = n_pre_dark + 2 * len(energies)
     # Fix up default parameters
     if ZP_X_drift_array is None:
-        ZP_X_drift_array = np.zeros_like(energies)
+        # Read-only view of zeros, no array is allocated
+        ZP_X_drift_array = np.broadcast_to(np.float64(0.), energies.shape)
     elif ZP_X_drift_array.shape != energies.shape:
         raise ValueError("ZP_X_drift_array shape does not match energies: "
                          "{} vs {}".format(ZP_X_drift_array.shape, energies.shape))
-    log.debug('ZP x-drift corrections: {}'.format(ZP_X_drift_array))
+    log.debug('ZP x-drift corrections: %s', ZP_X_drift_array)
     # Create the TXM object for this scan
     if txm is None:
         txm = new_txm()
@@ -203,41 +414,48 @@ def run_energy_scan(energies, exposure=0.5, n_pre_dark=5,
                                num_projections=total_projections)
             if use_fast_shutter:
                 txm.enable_fast_shutter()
-            txm.setup_hdf_writer(num_projections=total_projections)
+            # The HDF writer and the shutters are independent, so
+            # close the shutters while the writer is being set up
+            wait_for_writer = _in_background(txm.setup_hdf_writer,
+                                             num_projections=total_projections,
+                                             direct_chunk=True,
+                                             compression=compression)
+            if n_pre_dark > 0:
+                txm.close_shutters()
+            wait_for_writer()
             time.sleep(5)
             txm.start_logging(log_level)
             # Capture pre dark field images
             if n_pre_dark > 0:
-                txm.close_shutters()
                 log.info('Capturing %d Pre Dark Field images', n_pre_dark)
                 txm.capture_dark_field(num_projections=n_pre_dark)
             # Calculate the array of energies that will be scanned
             log.info('Capturing %d energies', len(energies))
             # Collect frames at each energy
             txm.open_shutters()
-            _capture_energy_frames(txm=txm, energies=energies,
-                                   constant_mag=constant_mag,
-                                   stabilize_sleep_ms=stabilize_sleep_ms,
-                                   sample_pos=sample_pos, out_pos=out_pos,
-                                   ZP_X_drift_array=ZP_X_drift_array)
+            capture_frames = _capture_energy_passes if two_pass else _capture_energy_frames
+            frames = [(np.nan, txm.FRAME_DARK)] * n_pre_dark
+            frames += capture_frames(txm=txm, energies=energies,
+                                     constant_mag=constant_mag,
+                                     stabilize_sleep_ms=stabilize_sleep_ms,
+                                     sample_pos=sample_pos, out_pos=out_pos,
+                                     ZP_X_drift_array=ZP_X_drift_array,
+                                     wait_for_energy=wait_for_energy)
             txm.close_shutters()
-            # Add the energy array to the active HDF file
+            # Let the HDF writer finish the frames it still has queued,
+            # and only stop it if fewer frames arrived than expected
+            if not txm.wait_pv('HDF1_Capture_RBV', txm.HDF_IDLE,
+                               timeout=HDF_DRAIN_TIMEOUT):
+                txm.HDF1_Capture = 0
+                txm.wait_pv('HDF1_WriteFile_RBV', txm.HDF_IDLE)
+            # Add the energy array to this repetition's HDF file
             hdf_filename = txm.hdf_filename
-            print ('1', hdf_filename)
+            log.debug('hdf_filename=%s', hdf_filename)
+            _save_energies(txm, hdf_filename, energies=energies,
+                           ZP_X_drift_array=ZP_X_drift_array, frames=frames)
             if pause:
                 log.info("Pausing between scans for %f min", pause)
                 time.sleep(pause * 60.0) # convert min to sec
-    try:
-        print ('2', hdf_filename)
-        with txm.hdf_file(hdf_filename, mode="r+") as hdf_f:
-            log.debug('Saving energies to file: %s', hdf_filename)
-            hdf_f.create_dataset('/exchange/energy',
-                                 data=energies)
-    except (OSError, IOError):
-        # Could not load HDF file, so raise a warning
-        msg = "Could not save energies to file %s" % hdf_filename
-        warnings.warn(msg, RuntimeWarning)
-        log.warning(msg)
     # Log the duration and output file
     duration = time.time() - start_time
     log.info('Energy scan took %d sec and saved in file %s',
@@ -268,7 +486,11 @@ def main():
     energies = energy_range_from_points(energy_points=energy_limits,
                                         energy_steps=energy_steps)
     ZP_X_drift = float(variableDict['ZP_X_drift'])
-    ZP_X_drift_array = (energies-energies[0]) * ZP_X_drift / (energies[-1]-energies[0])
+    # Scale linearly with energy, computed in place in one buffer
+    ZP_X_drift_array = np.subtract(energies, energies[0], dtype=np.float64)
+    energy_span = energies[-1] - energies[0]
+    if energy_span != 0:
+        ZP_X_drift_array *= ZP_X_drift / energy_span
     # Start scan sleep in min so min * 60 = sec
     sleep_min = float(variableDict.get('StartSleep_min', 0))
     stabilize_sleep_ms = float(variableDict.get("StabilizeSleep_ms"))
@@ -276,9 +498,13 @@ def main():
     pause = float(variableDict['Pause'])
     constant_mag = bool(variableDict['constant_mag'])
     use_fast_shutter = bool(int(variableDict['Use_Fast_Shutter']))
+    wait_for_energy = bool(int(variableDict.get('Wait_For_Energy', 0)))
+    two_pass = bool(int(variableDict.get('Two_Pass', 0)))
     if sleep_min > 0:
         log.debug("Sleeping for %f min", sleep_min)
-        time.sleep(sleep_min * 60.0)
+        if not start_sleep(sleep_min * 60.0):
+            log.info("Energy scan cancelled during start sleep")
+            return
     # Start the energy scan
     run_energy_scan(
         energies=energies, has_permit=SHUTTER_PERMIT,
@@ -293,6 +519,9 @@ def main():
         pause=pause,
         log_level=log_level,
         use_fast_shutter=use_fast_shutter,
+        wait_for_energy=wait_for_energy,
+        two_pass=two_pass,
+        compression=variableDict.get('Compression', None),
     )
 
 if __name__ == '__main__':
@@ -1,21 +1,13 @@
 # -*- coding: utf-8 -*-
 #######################
 
-'''For each energy step, a projection and then a flat field are
-acquired. The script calls the move_energy method from the TXM class.
+'''Watch the shaker PV and restart the shaker whenever it stops.
 
 '''
 
-import time
-import os
 import logging
-import warnings
+import threading
 
-import numpy as np
-import h5py
-import tqdm
-from scanlib.scan_variables import update_variable_dict, parse_list_variable
-from scanlib.tools import energy_range_from_points, loggingConfig
 from aps_32id.txm import new_txm
 
 __author__ = 'Mark Wolfman'
@@ -42,18 +34,27 @@ def monitor_shaker():
     """Ensure the shaker does not randomly stop running.
 
     """
-    def check_shaker(pvname, value, **kwargs):
-        pv_status = value
     txm = new_txm()
     pv = txm.epics_PV('Shaker')
-    pv_status = pv.get()
+    # The CA callback thread records the status and wakes the main
+    # thread, so nothing spins while the shaker is running
+    state = {'status': pv.get()}
+    restart_evt = threading.Event()
+    if state['status'] == STOPPED:
+        restart_evt.set()
+    def check_shaker(pvname=None, value=None, **kwargs):
+        state['status'] = value
+        if value == STOPPED:
+            restart_evt.set()
     index = pv.add_callback(check_shaker)
     try:
         print("Monitoring...")
         while True:
-            if pv_status == STOPPED:
+            restart_evt.wait(timeout=1.0)
+            if state['status'] == STOPPED:
                 log.info("Restarting shaker")
                 pv.put(RUNNING, wait=True)
+            restart_evt.clear()
     except:
         pv.remove_callback(index)
         print("stopped.")
@@ -64,5 +65,6 @@ def main():
     # Run in an infinte loop and ensure the shaker does not randomly stop
     monitor_shaker()
 
+
 if __name__ == '__main__':
     main()
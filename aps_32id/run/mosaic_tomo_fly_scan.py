@@ -5,17 +5,14 @@
 from __future__ import print_function
 
 import sys
-import json
 import time
-from epics import PV
-import h5py
-import shutil
-import os
-import imp
-import traceback
 import signal
 import random
 import string
+import itertools
+import threading
+
+import numpy as np
 
 from scanlib import *
 import tomo_fly_scan
@@ -31,6 +28,8 @@ VER_HOST = "txmtwo"
 VER_PORT = "5011"
 VER_DIR = "/local/usr32idc/conda/data-quality/controller_server.sh"
 INSTRUMENT = "/home/beams/USR32IDC/.dquality/32id_micro"
+# Tile moves smaller than this (in mm) are skipped
+TILE_TOLERANCE = 1e-4
 
 
 global variableDict
@@ -72,10 +71,33 @@ def set_exit_handler(func):
 def getVariableDict():
     return variableDict
 
+def move_tile_motors(moves, timeout=600.0, tolerance=TILE_TOLERANCE):
+    """Start all ``(pv, rbv_pv, value)`` moves at once, then wait for
+    every motor to report completion. Motors whose readback is already
+    within ``tolerance`` of their target are not moved. Returns False
+    if any motor did not finish within ``timeout``."""
+    events = []
+    for pv, rbv_pv, val in moves:
+        # Compare the readback, the setpoint can differ if a move was
+        # aborted or the motor stalled. It is monitored, so this reads
+        # the local copy
+        current = rbv_pv.get()
+        if current is not None and abs(current - val) < tolerance:
+            continue
+        done = threading.Event()
+        pv.put(val, use_complete=True, callback=lambda done=done, **kw: done.set())
+        events.append((pv, done))
+    completed = True
+    for pv, done in events:
+        if not done.wait(timeout):
+            print('Timed out waiting for', pv.pvname)
+            completed = False
+    return completed
+
 def main(key):
     update_variable_dict(variableDict)
     init_general_PVs(global_PVs, variableDict)
-    if variableDict.has_key('StopTheScan'):
+    if 'StopTheScan' in variableDict:
         cleanup(global_PVs, variableDict, VER_HOST, VER_PORT, key)
         return
     start_verifier(INSTRUMENT, None, variableDict, VER_DIR, VER_HOST, VER_PORT, key)
@@ -83,37 +105,37 @@ def main(key):
     FileName = global_PVs['HDF1_FileName'].get(as_string=True)
     FileTemplate = global_PVs['HDF1_FileTemplate'].get(as_string=True)
     global_PVs['HDF1_FileTemplate'].put('%s%s.h5')
-    if int(variableDict['Y_NumTiles']) <= 1:
-        y_itr = 0.0
-    else:
-        y_itr = ((float(variableDict['Y_Stop']) - float(variableDict['Y_Start'])) / (float(variableDict['Y_NumTiles']) - 1))
-    if int(variableDict['X_NumTiles']) <= 1:
-        x_itr = 0.0
-    else:
-        x_itr = ((float(variableDict['X_Stop']) - float(variableDict['X_Start'])) / (float(variableDict['X_NumTiles']) - 1))
-    y_val = float(variableDict['Y_Start'])
-    for y in range( int(variableDict['Y_NumTiles']) ):
-        x_val = float(variableDict['X_Start'])
-        global_PVs['Motor_Y_Tile'].put(y_val, wait=True, timeout=600.0)
-        #print('sleep', float(variableDict['MosaicMoveSleep']))
-        #time.sleep(float(variableDict['MosaicMoveSleep']))
-        #wait_pv(global_PVs["Motor_Y_Tile"], y_val, 600)
-        y_val += y_itr
-        for x in range( int(variableDict['X_NumTiles']) ):
-            print(y_val, x_val)
-            global_PVs["Motor_X_Tile"].put(x_val, wait=True, timeout=600.0)
-            print('sleep', float(variableDict['MosaicMoveSleep']))
-            time.sleep(float(variableDict['MosaicMoveSleep']))
-            #wait_pv(global_PVs["Motor_X_Tile"], x_val, 600)
-            x_val += x_itr
-            tomo_fly_scan.start_scan(variableDict, FileName+'_y' + str(y) + '_x' + str(x) )
+    # Tile positions are computed directly so they don't drift across large grids
+    ys = np.linspace(float(variableDict['Y_Start']), float(variableDict['Y_Stop']),
+                     max(int(variableDict['Y_NumTiles']), 1))
+    xs = np.linspace(float(variableDict['X_Start']), float(variableDict['X_Stop']),
+                     max(int(variableDict['X_NumTiles']), 1))
+    mosaic_sleep = float(variableDict['MosaicMoveSleep'])
+    mx = global_PVs["Motor_X_Tile"]
+    my = global_PVs['Motor_Y_Tile']
+    mx_rbv = global_PVs['Motor_X_Tile_RBV']
+    my_rbv = global_PVs['Motor_Y_Tile_RBV']
+    last_y = None
+    for (y, y_val), (x, x_val) in itertools.product(enumerate(ys), enumerate(xs)):
+        moves = [(mx, mx_rbv, x_val)]
+        if y_val != last_y:
+            moves.append((my, my_rbv, y_val))
+            last_y = y_val
+        print(y_val, x_val)
+        if not move_tile_motors(moves, timeout=600.0):
+            # Don't scan (and mislabel) a tile the stage never reached
+            print('Tile motors did not reach', y_val, x_val, '- stopping the mosaic')
+            break
+        print('sleep', mosaic_sleep)
+        time.sleep(mosaic_sleep)
+        tomo_fly_scan.start_scan(variableDict, FileName+'_y' + str(y) + '_x' + str(x) )
     global_PVs['Fly_ScanControl'].put('Standard')
     global_PVs['HDF1_FileName'].put(FileName)
     global_PVs['HDF1_FileTemplate'].put('%s%s_%3.3d.h5')
 
 
 if __name__ == '__main__':
-    key = ''.join(random.choice(string.letters[26:]+string.digits) for _ in range(10))
+    key = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
     def on_exit(sig, func=None):
         cleanup(global_PVs, variableDict, VER_HOST, VER_PORT, key)
         sys.exit(0)
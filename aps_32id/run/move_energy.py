@@ -2,11 +2,7 @@
 
 """
 
-import os
 import logging
-import time
-from epics import PV
-import math
 
 log = logging.getLogger(__name__)
 
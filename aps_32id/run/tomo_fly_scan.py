@@ -6,22 +6,10 @@ FlyScan for Sector 32-ID-C
 from __future__ import division, print_function
 
 import logging
-
-import sys
-import json
 import time
-from epics import PV
-import h5py
-import shutil
-import os
-import imp
-import traceback
-import signal
-import random
-import string
 
 from aps_32id.txm import new_txm
-from scanlib.tools import expand_position, loggingConfig
+from scanlib.tools import expand_position, loggingConfig, start_sleep
 from scanlib.scan_variables import update_variable_dict
 
 __author__ = 'Mark Wolfman'
@@ -64,6 +52,8 @@ variableDict = {
     #'ExternalShutter': 0,
     'FileWriteMode': 'Stream',
     'UseInterferometer': 0,
+    'Compression': None,
+    'SWMR': 0, # 1 = let the verifier read frames while the scan runs
     # Logging: 0=UNSET, 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
     'Log_Level': logging.DEBUG,
 }
@@ -79,7 +69,7 @@ def run_tomo_fly_scan(projections=3000, rotation_start=0,
                       rotation_end=180, exposure=0.2,
                       num_white=(5, 5), num_dark=(5, 0),
                       sample_pos=(None,), out_pos=(None,),
-                      log_level=logging.INFO,
+                      compression=None, swmr=False, log_level=logging.INFO,
                       txm=None):
     """Collect a 180° tomogram in fly-scan mode.
     
@@ -107,13 +97,19 @@ def run_tomo_fly_scan(projections=3000, rotation_start=0,
       4 (or less) tuple of (x, y, z, θ°) for the sample position.
     out_pos : 4-tuple(float), optional
       4 (or less) tuple of (x, y, z, θ°) for white field position.
+    compression : str, optional
+      Passed on to :meth:`NanoTXM.setup_hdf_writer`.
+    swmr : bool, optional
+      If true, the HDF file is written in single-writer/multiple-reader
+      mode so frames can be read (eg. by the verifier) before the
+      scan finishes.
     log_level : int, optional
       Temporary log level to use. ``None`` does not change the logging.
     txm : optional
       An instance of the NanoTXM class. If not given, a new one will
       be created. Mostly used for testing.
     """
-    logging.debug("Starting run_tomo_fly_scan()")
+    log.debug("Starting run_tomo_fly_scan()")
     start_time = time.time()
     # Unpack options
     num_pre_white_images, num_post_white_images = num_white
@@ -121,7 +117,7 @@ def run_tomo_fly_scan(projections=3000, rotation_start=0,
     sample_pos = expand_position(sample_pos)
     out_pos = expand_position(out_pos)
     num_pre_images = num_pre_dark_images + num_pre_white_images
-    num_post_images = num_pre_dark_images + num_pre_white_images
+    num_post_images = num_post_dark_images + num_post_white_images
     total_projections = (projections + num_pre_images + num_post_images)
     # Create the TXM object for this scan
     if txm is None:
@@ -131,7 +127,10 @@ def run_tomo_fly_scan(projections=3000, rotation_start=0,
         # Prepare camera, etc.
         txm.setup_detector(exposure=exposure,
                            num_projections=total_projections)
-        txm.setup_hdf_writer(num_projections=total_projections)
+        # One frame per chunk matches how frames are written and read
+        txm.setup_hdf_writer(num_projections=total_projections,
+                             direct_chunk=True, compression=compression,
+                             swmr=swmr)
         txm.start_logging(level=log_level)
         # Capture pre dark field images
         if num_pre_dark_images > 0:
@@ -156,8 +155,10 @@ def run_tomo_fly_scan(projections=3000, rotation_start=0,
         with txm.wait_pvs():
             txm.move_sample(*sample_pos)
             txm.open_shutters()
+            # The detector waits for external triggers, so it can be
+            # armed while the sample and shutters are still moving
+            txm.start_detector(num_projections=projections)
         txm.move_sample(theta=rotation_start)
-        txm.start_detector(num_projections=projections)
         angles = txm.capture_tomogram_flyscan(start_angle=rotation_start,
                                               end_angle=rotation_end,
                                               num_projections=projections)
@@ -179,10 +180,10 @@ def run_tomo_fly_scan(projections=3000, rotation_start=0,
         # wait_pv(global_PVs["HDF1_Capture_RBV"], 0, 600)
         hdf_filename = txm.hdf_filename
     # Save metadata
-    with txm.hdf_file(hdf_filename=hdf_filename) as f:
+    with txm.hdf_file(hdf_filename=hdf_filename, mode="r+") as f:
         f.create_dataset('/exchange/theta', data=angles)
-    logging.info("Finished fly scan tomogram in {:.2f} sec"
-                 "".format(time.time() - start_time))
+    log.info("Finished fly scan tomogram in %.2f sec",
+             time.time() - start_time)
 
 
 def main():
@@ -193,11 +194,16 @@ def main():
     loggingConfig(level=log_level)
     # Extract variables from the global dictionary
     sleep_time = float(variableDict['StartSleep_min']) * 60.0
-    # Prepare variables
-    angles = []
-    # Pre-scan sleep
+    start_deadline = time.time() + sleep_time
+    # Connect to the instrument while waiting to start
+    txm = new_txm()
+    txm.connect_pvs()
+    # Pre-scan sleep, for whatever time is left
+    sleep_time = max(start_deadline - time.time(), 0)
     log.debug("Sleeping for %d seconds", int(sleep_time))
-    time.sleep(sleep_time)
+    if not start_sleep(sleep_time):
+        log.info("Fly scan cancelled during start sleep")
+        return
     # Start the experiment
     num_white = (int(variableDict['PreWhiteImages']),
                  int(variableDict['PostWhiteImages']))
@@ -218,7 +224,10 @@ def main():
                       exposure=variableDict['ExposureTime'],
                       num_white=num_white, num_dark=num_dark,
                       sample_pos=sample_pos, out_pos=out_pos,
-                      log_level=int(variableDict['Log_Level']),)
+                      compression=variableDict.get('Compression', None),
+                      swmr=bool(int(variableDict.get('SWMR', 0))),
+                      log_level=int(variableDict['Log_Level']),
+                      txm=txm)
 
 
 if __name__ == '__main__':
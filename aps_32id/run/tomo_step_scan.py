@@ -63,6 +63,10 @@ variableDict = {
     # 'FileWriteMode': 'Stream',
     'rot_speed_deg_per_s': 0.5,
     'Use_Fast_Shutter': 1,
+    'Display_live': 1, # 0 = no live image from the IOC during the scan
+    'Compression': None,
+    'Tile_Size': 0, # HDF chunk rows/columns, 0 = whole frames
+    'Frames_Per_Chunk': 1, # eg. 16 with 'Tile_Size' 256 for sinogram reads
     # Logging: 0=UNSET, 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
     'Log_Level': logging.INFO,
 }
@@ -82,7 +86,8 @@ def run_tomo_step_scan(angles, stabilize_sleep_ms=10, exposure=0.5,
                        rot_speed_deg_per_s=0.5, key=None,
                        log_level=logging.INFO,
                        use_fast_shutter=True,
-                       txm=None):
+                       compression=None, tile_size=None,
+                       frames_per_chunk=1, live_display=True, txm=None):
     """Collect a series of projections at multiple angles.
     
     The given angles should span a range of 180°. The frames will be
@@ -114,6 +119,17 @@ def run_tomo_step_scan(angles, stabilize_sleep_ms=10, exposure=0.5,
     use_fast_shutter : bool, optional
       Whether to open and shut the fast shutter before triggering
       projections.
+    compression : str, optional
+      Passed on to :meth:`NanoTXM.setup_hdf_writer`.
+    tile_size : int, optional
+      Split each frame into square HDF chunks of this many pixels on
+      a side. See :py:meth:`NanoTXM.setup_hdf_writer`.
+    frames_per_chunk : int, optional
+      How many frames go in each HDF chunk. Combined with
+      ``tile_size``, deeper chunks make sinogram reads faster.
+    live_display : bool, optional
+      If false, the live image feed is turned off while the
+      projections are collected, and turned back on afterwards.
     log_level : int, optional
       Temporary log level to use. None (default) does not change the logging.
     txm : optional
@@ -144,17 +160,19 @@ def run_tomo_step_scan(angles, stabilize_sleep_ms=10, exposure=0.5,
         total_projections += num_pre_white_images + num_post_white_images
         total_projections += num_pre_dark_images + num_post_dark_images
         txm.setup_detector(num_projections=total_projections,
-                           exposure=exposure)
-        txm.setup_hdf_writer(num_projections=total_projections)
+                           exposure=exposure, live_display=live_display)
+        txm.setup_hdf_writer(num_projections=total_projections,
+                             compression=compression, tile_size=tile_size,
+                             frames_per_chunk=frames_per_chunk)
         txm.start_logging(level=log_level)
         # Collect pre-scan dark-field images
         if num_pre_dark_images > 0:
-            logging.info("Capturing %d dark-fields at %s", num_pre_dark_images, out_pos)
+            log.info("Capturing %d dark-fields at %s", num_pre_dark_images, out_pos)
             txm.close_shutters()
             txm.capture_dark_field(num_projections=num_pre_dark_images)
         # Collect pre-scan white-field images
         if num_pre_white_images > 0:
-            logging.info("Capturing %d flat-fields at %s", num_pre_white_images, out_pos)
+            log.info("Capturing %d flat-fields at %s", num_pre_white_images, out_pos)
             # Move the sample out and collect whitefields
             txm.move_sample(theta=out_pos[3]) # So we don't have crashes
             with txm.wait_pvs():
@@ -163,7 +181,7 @@ def run_tomo_step_scan(angles, stabilize_sleep_ms=10, exposure=0.5,
             txm.capture_white_field(num_projections=num_pre_white_images)
         # Capture the actual sample data
         # txm.move_sample(theta=0) # So we don't have crashes
-        txm.move_sample(sample_pos[3])
+        txm.move_sample(theta=sample_pos[3])
         with txm.wait_pvs():
             txm.move_sample(*sample_pos)
             txm.open_shutters()
@@ -205,7 +223,7 @@ def main():
     log_level = variableDict['Log_Level']
     tools.loggingConfig(level=log_level)
     # Prepare the exit handler
-    key = ''.join(random.choice(string.letters[26:]+string.digits) for _ in range(10))
+    key = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
     def on_exit(sig, func=None):
         cleanup(global_PVs, variableDict, VER_HOST, VER_PORT, key)
         sys.exit(0)
@@ -232,12 +250,17 @@ def main():
                variableDict.get('SampleYOut', None),
                variableDict.get('SampleZOut', None),
                variableDict.get('SampleRotOut', None))
-    step_size = ((sample_rot_end - sample_rot_start) / (num_projections - 1.0))
     stabilize_sleep_ms = float(variableDict['StabilizeSleep_ms'])
-    use_fast_shutter = use_fast_shutter=bool(int(variableDict['Use_Fast_Shutter']))
+    use_fast_shutter = bool(int(variableDict['Use_Fast_Shutter']))
+    compression = variableDict.get('Compression', None)
+    tile_size = int(variableDict.get('Tile_Size', 0)) or None
+    frames_per_chunk = int(variableDict.get('Frames_Per_Chunk', 1))
+    live_display = bool(int(variableDict.get('Display_live', 1)))
     # Pre-scan sleep
     log.debug("Sleeping for %d seconds", int(sleep_time))
-    time.sleep(sleep_time)
+    if not tools.start_sleep(sleep_time):
+        log.info("Step scan cancelled during start sleep")
+        return
     # Call the main tomography function
     return run_tomo_step_scan(angles=angles,
                               stabilize_sleep_ms=stabilize_sleep_ms,
@@ -246,6 +269,10 @@ def main():
                               sample_pos=sample_pos, out_pos=out_pos,
                               rot_speed_deg_per_s=rot_speed_deg_per_s,
                               use_fast_shutter=use_fast_shutter,
+                              compression=compression,
+                              tile_size=tile_size,
+                              frames_per_chunk=frames_per_chunk,
+                              live_display=live_display,
                               log_level=log_level)
 
 
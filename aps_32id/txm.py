@@ -17,7 +17,9 @@ import datetime as dt
 import time
 import math
 import logging
+import logging.handlers
 import warnings
+import threading
 from contextlib import contextmanager
 from collections import namedtuple
 import six
@@ -30,7 +32,7 @@ import numpy as np
 import h5py
 import tqdm
 import pytz
-from epics import PV as EpicsPV, get_pv, poll as epics_poll
+from epics import get_pv
 
 from scanlib import TxmPV, permit_required, exceptions_, PVMonitor
 
@@ -44,6 +46,7 @@ __all__ = ['NanoTXM',
            'txm_config',]
 
 DEFAULT_TIMEOUT = 20 # PV timeout in seconds
+PUT_TIMEOUT = 300 # Queued put callback timeout in seconds
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
@@ -107,14 +110,32 @@ class txm_config():
 
 class PVPromise():
     is_complete = False
+    completed_at = None
     result = None
     
     def __init__(self, pv_name=""):
         self.pv_name = pv_name
+        self.completed = threading.Event()
     
     def complete(self, pvname="", *args, **kwargs):
         log.debug("Completed pv %s", self.pv_name)
+        self.completed_at = time.time()
         self.is_complete = True
+        self.completed.set()
+    
+    def wait(self, timeout=-1):
+        """Block until the put callback has fired.
+        
+        Negative ``timeout`` waits forever. Returns ``True`` if the
+        callback fired, or ``False`` if the timeout expired first.
+        
+        """
+        deadline = None if timeout < 0 else time.time() + timeout
+        # Wake up every so often so Ctrl-C still works on python 2
+        while not self.completed.wait(timeout=1):
+            if deadline is not None and time.time() >= deadline:
+                return self.completed.is_set()
+        return True
     
     def __str__(self):
         return self.pv_name
@@ -159,7 +180,6 @@ class NanoTXM(object):
     
     """
     gap_offset = 0.17 # Added to undulator gap setting
-    pv_queue = None
     ioc_prefix = "32idcPG3:"
     hdf_writer_ready = False
     tiff_writer_ready = False
@@ -170,6 +190,7 @@ class NanoTXM(object):
     fast_shutter_enabled = False
     E_RANGE = (6.4, 30) # How far can the X-ray energy be changed (in keV)
     POLL_INTERVAL = 0.01 # How often to check PV's in seconds.
+    LOG_BUFFER_SIZE = 100 # Log records to hold before writing the log file
     # XML file values to use
     detector_xml = "nctDetectorAttributes.xml"
     hdf_xml = "nct.xml"
@@ -212,6 +233,7 @@ class NanoTXM(object):
     DETECTOR_ABORTED = 10
     HDF_IDLE = 0
     HDF_WRITING = 1
+    BLOSC_LEVEL = 3
     TRIGGER_INTERNAL = 'Internal'
     TRIGGER_EXTERNAL = 'Ext. Standard'
     TRIGGER_OVERLAPPED = 'Overlapped'
@@ -263,6 +285,15 @@ class NanoTXM(object):
     HDF1_ArrayPort = TxmPV('{ioc_prefix}HDF1:NDArrayPort')
     HDF1_NextFile = TxmPV('{ioc_prefix}HDF1:FileNumber')
     HDF1_XMLFile = TxmPV('{ioc_prefix}HDF1:XMLFileName')
+    HDF1_ChunkSizeAuto = TxmPV('{ioc_prefix}HDF1:ChunkSizeAuto')
+    HDF1_NumFramesChunks = TxmPV('{ioc_prefix}HDF1:NumFramesChunks')
+    HDF1_NumRowChunks = TxmPV('{ioc_prefix}HDF1:NumRowChunks')
+    HDF1_NumColChunks = TxmPV('{ioc_prefix}HDF1:NumColChunks')
+    HDF1_SWMRMode = TxmPV('{ioc_prefix}HDF1:SWMRMode')
+    HDF1_Compression = TxmPV('{ioc_prefix}HDF1:Compression')
+    HDF1_BloscCompressor = TxmPV('{ioc_prefix}HDF1:BloscCompressor')
+    HDF1_BloscCompressLevel = TxmPV('{ioc_prefix}HDF1:BloscCompressLevel')
+    HDF1_BloscShuffle = TxmPV('{ioc_prefix}HDF1:BloscShuffle')
     
     # Tiff writer PV's
     TIFF1_AutoSave = TxmPV('{ioc_prefix}TIFF1:AutoSave')
@@ -294,6 +325,7 @@ class NanoTXM(object):
     
     # Zone plate:
     zone_plate_x = TxmPV('32idcTXM:mcs:c2:m1.VAL')
+    zone_plate_x_RBV = TxmPV('32idcTXM:mcs:c2:m1.RBV')
     zone_plate_y = TxmPV('32idcTXM:mcs:c2:m2.VAL')
     zone_plate_z = TxmPV('32idcTXM:mcs:c2:m3.VAL')
     
@@ -393,6 +425,41 @@ class NanoTXM(object):
         self.drn = config.getfloat('zone_plate_drn')
         self.zp_diameter = config.getfloat('zone_plate_diameter')
     
+    def connect_pvs(self, timeout=5):
+        """Connect to all the process variables used by this instrument.
+        
+        PVs otherwise connect the first time they are used, during the
+        scan itself. Calling this beforehand (eg. during the start
+        sleep) gets the connection time out of the way.
+        
+        Parameters
+        ----------
+        timeout : float, optional
+          How long to wait, in seconds, for all the PVs together.
+        
+        Returns
+        -------
+        unconnected : list
+          Names of the PVs that did not connect in time.
+        
+        """
+        pv_names = set()
+        for cls in type(self).__mro__:
+            for attr in vars(cls).values():
+                if isinstance(attr, TxmPV):
+                    pv_names.add(attr.pv_name(self))
+        # Start all the searches at once, then wait on them together
+        epics_pvs = [get_pv(name, connect=False) for name in sorted(pv_names)]
+        deadline = time.time() + timeout
+        unconnected = []
+        for epics_pv in epics_pvs:
+            remaining = max(deadline - time.time(), 0)
+            if not epics_pv.wait_for_connection(timeout=remaining):
+                unconnected.append(epics_pv.pvname)
+        if unconnected:
+            log.warning("Could not connect to PVs: %s", ", ".join(unconnected))
+        return unconnected
+    
     def pv_get(self, pv_name, *args, **kwargs):
         """Retrieve the current process variable value.
         
@@ -402,9 +469,34 @@ class NanoTXM(object):
           Extra arguments that get passed to :py:meth:``epics.PV.get``
         
         """
-        epics_pv = EpicsPV(pv_name)
+        # Reuse the connected PV instead of searching for it again
+        epics_pv = get_pv(pv_name)
         return epics_pv.get(*args, **kwargs)
     
+    @property
+    def pv_queue(self):
+        """Promises for PVs set inside the current ``wait_pvs`` block,
+        or ``None`` outside of one.
+        
+        Each thread gets its own queue, so a move running in a
+        background thread does not turn the blocking puts of another
+        thread into deferred ones.
+        
+        """
+        return getattr(self._thread_state(), 'pv_queue', None)
+    
+    @pv_queue.setter
+    def pv_queue(self, queue):
+        self._thread_state().pv_queue = queue
+    
+    def _thread_state(self):
+        # Created on first use, so subclasses can set the queue
+        # before calling ``__init__``
+        state = self.__dict__.get('_local')
+        if state is None:
+            state = self.__dict__.setdefault('_local', threading.local())
+        return state
+    
     def pv_put(self, pv_name, value, wait, *args, **kwargs):
         """Set the current process variable value.
         
@@ -425,7 +517,7 @@ class NanoTXM(object):
           Extra arguments that get passed to :py:meth:``epics.PV.get``
         
         """
-        if self.pv_queue is not None:
+        if wait and self.pv_queue is not None:
             # Non-blocking, deferred PV waiting
             promise = PVPromise(pv_name=pv_name)
             ret = self._pv_put(pv_name, value, wait=False,
@@ -443,11 +535,11 @@ class NanoTXM(object):
     
     def _pv_put(self, pv_name, value, wait, *args, **kwargs):
         """Retrieves the epics PV and calls its ``put`` method."""
-        epics_pv = EpicsPV(pv_name)
+        epics_pv = get_pv(pv_name)
         return epics_pv.put(value, wait=wait, *args, **kwargs)
     
     @contextmanager
-    def wait_pvs(self, block=True):
+    def wait_pvs(self, block=True, timeout=PUT_TIMEOUT):
         """Context manager that allows for setting multiple PVs
         asynchronously.
         
@@ -462,6 +554,10 @@ class NanoTXM(object):
         block : bool, optional
           If True, this function will wait for all PVs to finish
         before continuing.
+        timeout : float, optional
+          How long to wait, in seconds, for all the PVs to finish
+          before raising ``TimeoutError``. Negative values cause the
+          function to wait forever.
         
         """
         # Save old queue to resore it later on
@@ -473,19 +569,54 @@ class NanoTXM(object):
         # Track some performance values
         start_time = time.time()
         num_promises = len(self.pv_queue)
-        pv_times = {str(pv): 0 for pv in self.pv_queue}
-        # Wait for all the PVs to be finished
-        while block and not all([pv.is_complete for pv in self.pv_queue]):
-            # Update the timing trackers
-            time_diff = time.time() - start_time
-            new_times = {str(pv): time_diff for pv in self.pv_queue if not pv.is_complete}
-            pv_times.update(new_times)
-            time.sleep(0.01)
-        log.debug("Completed %d queued PV's: %s", num_promises, pv_times)
-        # Restore the old PV queue
-        self.pv_queue = old_queue
-    
-    def wait_pv(self, pv_name, target_val, timeout=DEFAULT_TIMEOUT):
+        # Wait for all the PVs to be finished, sleeping until each
+        # put callback fires instead of polling
+        try:
+            if block:
+                deadline = start_time + timeout
+                for promise in self.pv_queue:
+                    remaining = -1 if timeout < 0 else max(deadline - time.time(), 0)
+                    if not promise.wait(timeout=remaining):
+                        msg = ("Timed out waiting for PV '{}' after {}s"
+                               "".format(promise, timeout))
+                        log.error(msg)
+                        raise exceptions_.TimeoutError(msg)
+            pv_times = {str(pv): max(pv.completed_at - start_time, 0)
+                        for pv in self.pv_queue if pv.is_complete}
+            log.debug("Completed %d queued PV's: %s", num_promises, pv_times)
+        finally:
+            # Restore the old PV queue
+            self.pv_queue = old_queue
+    
+    @contextmanager
+    def pv_update_event(self, pv_name):
+        """Context manager that yields a ``threading.Event`` which is
+        set whenever the process variable sends a new value.
+        
+        The event is cleared before it is yielded, so only updates
+        that arrive inside the ``with`` block will set it.
+        
+        Parameters
+        ----------
+        pv_name : str
+          The name of the PV object. Should match the attribute on
+          this TXM() object.
+        
+        """
+        real_PV = getattr(type(self), pv_name)
+        epics_pv = get_pv(real_PV.pv_name(self))
+        updated = threading.Event()
+        callback_idx = epics_pv.add_callback(lambda **kwargs: updated.set())
+        try:
+            # Make sure the initial value after connecting doesn't count
+            epics_pv.get()
+            updated.clear()
+            yield updated
+        finally:
+            epics_pv.remove_callback(callback_idx)
+    
+    def wait_pv(self, pv_name, target_val, timeout=DEFAULT_TIMEOUT,
+                quiet=False):
         """Wait for a process variable to reach given value.
         
         This function polls the process variable (PV) and blocks until
@@ -503,6 +634,9 @@ class NanoTXM(object):
         timeout : int, optional
           How long to wait, in seconds, before giving up. Negative
           values cause the function to wait forever.
+        quiet : bool, optional
+          If true, a timeout is expected and is only logged at DEBUG
+          level instead of raising a warning.
         
         Returns
         -------
@@ -516,27 +650,22 @@ class NanoTXM(object):
         # Delay for pv to change
         # time.sleep(self.POLL_INTERVAL)
         startTime = time.time()
-        # Enter into infinite loop polling the PV status
         real_PV = getattr(type(self), pv_name)
         pv_name = real_PV.pv_name(self)
         with PVMonitor(pv_name) as mon:
-            while(True):
-                if (mon.latest_value != target_val):
-                    if timeout > -1:
-                        # Check for timeouts and break out of the loop
-                        curTime = time.time()
-                        diffTime = curTime - startTime
-                        if diffTime >= timeout:
-                            msg = ("Timed out '{}' ({}) after {}s"
-                                   "".format(pv_name, target_val, timeout))
-                            warnings.warn(msg, RuntimeWarning)
-                            log.warn(msg)
-                            break
-                    epics_poll()
-                else:
-                    log.debug("Ended wait_pv({}) after {:.2f} sec."
-                              "".format(pv_name, time.time() - startTime))
-                    return True
+            # The monitor callback wakes this thread on each new value
+            if mon.wait_for_value(target_val, timeout=timeout):
+                log.debug("Ended wait_pv({}) after {:.2f} sec."
+                          "".format(pv_name, time.time() - startTime))
+                return True
+        msg = ("Timed out '{}' ({}) after {}s"
+               "".format(pv_name, target_val, timeout))
+        if quiet:
+            log.debug(msg)
+        else:
+            warnings.warn(msg, RuntimeWarning)
+            log.warn(msg)
+        return False
     
     def sample_position(self):
         """Retrieve the x, y, z and theta positions of the sample stage.
@@ -568,13 +697,23 @@ class NanoTXM(object):
         log.debug('Moving sample to (%s, %s, %s)', x, y, z)
         if theta is not None:
             self.Motor_SampleRot = float(theta)
-        if x is not None:
-            self.Motor_Sample_Top_X = float(x)
-        if y is not None:
-            self.Motor_SampleY = float(y)
-        if z is not None:
-            self.Motor_Sample_Top_Z = float(z)
-        # Log actual x, y, z, θ values
+        axes = (('Motor_Sample_Top_X', x), ('Motor_SampleY', y),
+                ('Motor_Sample_Top_Z', z))
+        moves = [(attr, float(val)) for attr, val in axes if val is not None]
+        if len(moves) > 1 and self.pv_queue is None:
+            # Start the x, y, z moves together and wait for all of
+            # them, instead of one after the other (inside a
+            # ``wait_pvs`` block they are already queued together)
+            with self.wait_pvs():
+                for attr, val in moves:
+                    setattr(self, attr, val)
+        else:
+            for attr, val in moves:
+                setattr(self, attr, val)
+        # Log actual x, y, z, θ values (reading them back costs four
+        # channel access gets, so skip it unless someone is listening)
+        if not log.isEnabledFor(logging.DEBUG):
+            return
         msg = "Sample moved to (x={x:.2f}, y={y:.2f}, z={z:.2f}, θ={theta:.2f}°)"
         try:
             msg = msg.format(
@@ -840,13 +979,26 @@ class NanoTXM(object):
     def hdf_filename(self):
         return self.HDF1_FullFileName_RBV
     
-    def hdf_file(self, hdf_filename=None, timeout=30, *args, **kwargs):
+    def hdf_file(self, hdf_filename=None, timeout=30, rdcc_nbytes=None,
+                 rdcc_nslots=None, rdcc_w0=None, *args, **kwargs):
+        """Open the HDF file once the HDF writer is done with it.
+        
+        ``rdcc_nbytes``, ``rdcc_nslots`` and ``rdcc_w0`` set the
+        chunk cache and are passed to ``h5py.File``. If ``None``
+        (default), the HDF5 library defaults are used. Remaining
+        arguments also go to ``h5py.File``.
+        
+        """
         # Get current hdf filename
         if hdf_filename is None:
             hdf_filename = self.hdf_filename
+        # Only pass cache settings that were given
+        cache_kw = dict(rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots,
+                        rdcc_w0=rdcc_w0)
+        kwargs.update({k: v for k, v in cache_kw.items() if v is not None})
         # Wait for the HDF writer to be done using the HDF file
         self.wait_pv('HDF1_Capture_RBV', self.HDF_IDLE, timeout=timeout)
-        return h5py.File(self.hdf_filename, *args, **kwargs)
+        return h5py.File(hdf_filename, *args, **kwargs)
     
     @property
     def exposure_time(self):
@@ -872,7 +1024,8 @@ class NanoTXM(object):
         self.reset_ccd()
         self.reset_ccd()
     
-    def setup_detector(self, num_projections, exposure=0.5):
+    def setup_detector(self, num_projections, exposure=0.5,
+                       live_display=True):
         """Prepare the Poing-Grey detector to start collecting projections.
         
         Parameters
@@ -883,6 +1036,10 @@ class NanoTXM(object):
           become idle.
         exposure : float, optional
           How long (in sec) to collect each exposure for.
+        live_display : bool, optional
+          If false, the image plugin that feeds live viewers is
+          disabled until the detector is reset, so the IOC does not
+          publish every frame over channel access during the scan.
         
         """
         log.debug("Setting up detector for %d (%f s) projections.",
@@ -899,7 +1056,7 @@ class NanoTXM(object):
         self.HDF1_EnableCallbacks = self.CALLBACK_ENABLED
         # Now set the real settings for the detector
         self.Cam1_ImageMode = self.IMAGE_MODE_MULTIPLE
-        self.Cam1_Display = True
+        self.Cam1_Display = bool(live_display)
         self.Cam1_ArrayCallbacks = 'Enable'
         self.Cam1_FrameRateOnOff = False
         self.Cam1_TriggerSource = self.GPIO_0
@@ -932,7 +1089,9 @@ class NanoTXM(object):
         self.wait_pv('Cam1_Status', self.DETECTOR_WAITING)        
     
     def setup_hdf_writer(self, num_projections=1, write_mode="Stream",
-                         num_recursive_images=1):
+                         num_recursive_images=1, direct_chunk=False,
+                         swmr=False, compression=None, tile_size=None,
+                         frames_per_chunk=1):
         """Prepare the HDF file writer to accept data.
         
         Parameters
@@ -944,9 +1103,39 @@ class NanoTXM(object):
         num_recursive_images : int, optional
           How many images to use in the recursive filter. If 1
           (default), recursive filtering will be disabled.
+        direct_chunk : bool, optional
+          If true, store each frame as its own chunk. Frames that
+          arrive already compressed (eg. from a codec plugin) are then
+          written straight to the file with direct chunk writes instead
+          of passing through the HDF5 filter pipeline.
+        swmr : bool, optional
+          If true, the HDF writer uses single-writer/multiple-reader
+          mode so other processes can read frames while the scan is
+          still running. Needs an IOC built with SWMR support. If
+          false (default), SWMR mode is turned off.
+        compression : str, optional
+          Compression filter for the HDF plugin (eg. "None", "zlib",
+          "Blosc"). "Blosc" uses the LZ4 codec with byte shuffling,
+          which is fast enough to keep up with the detector. If
+          ``None`` (default), the plugin's current setting is kept.
+        tile_size : int, optional
+          If given, each frame is split into square chunks of this
+          many pixels on a side, so readers that only need a region
+          of interest don't have to read whole frames. Cannot be
+          combined with ``direct_chunk``.
+        frames_per_chunk : int, optional
+          How many consecutive frames go in each chunk. Deeper chunks
+          (together with ``tile_size``) suit sinogram reads, which
+          take a few rows from every frame. Aim for chunks around
+          1 MB. Cannot be combined with ``direct_chunk``. Defaults
+          to one frame per chunk.
         
         """
         log.debug('setup_hdf_writer() called')
+        if direct_chunk and (tile_size is not None or frames_per_chunk > 1):
+            raise ValueError("direct_chunk needs single whole-frame chunks, "
+                             "so it cannot be used with tile_size "
+                             "or frames_per_chunk.")
         self.HDF1_LazyOpen = 0 # has to be 0 (for some reasons...)
         # Load the correct XML attributes
         self.HDF1_XMLFile = self.hdf_xml
@@ -965,6 +1154,25 @@ class NanoTXM(object):
             # No recursive filter, just 1 image
             self.Proc1_Filter_Enable = 'Disable'
             self.HDF1_ArrayPort = self.Proc1_ArrayPort
+        # Chunks span whole frames unless tiles are requested. This is
+        # always set so tiles from an earlier scan don't carry over
+        if tile_size is None:
+            self.HDF1_ChunkSizeAuto = 'Yes'
+        else:
+            self.HDF1_ChunkSizeAuto = 'No'
+            self.HDF1_NumRowChunks = tile_size
+            self.HDF1_NumColChunks = tile_size
+        # One frame per chunk by default (needed for direct chunk
+        # writes), also undoing deeper chunks from an earlier scan
+        self.HDF1_NumFramesChunks = frames_per_chunk
+        # Always set, so an earlier SWMR scan doesn't carry over
+        self.HDF1_SWMRMode = 'On' if swmr else 'Off'
+        if compression is not None:
+            self.HDF1_Compression = compression
+            if compression == 'Blosc':
+                self.HDF1_BloscCompressor = 'LZ4'
+                self.HDF1_BloscCompressLevel = self.BLOSC_LEVEL
+                self.HDF1_BloscShuffle = 'Byte'
         # Count total number of projections needed
         self.HDF1_NumCapture = num_projections
         self.HDF1_FileWriteMode = write_mode
@@ -1148,14 +1356,27 @@ class NanoTXM(object):
         delta = (end_angle - start_angle) / (num_projections)
         total_time = num_projections * (self.exposure_time + ccd_readout)
         slew_speed = (end_angle - start_angle) / total_time
-        # Set values for fly scan parameters
-        self.Fly_ScanControl = "Custom"
-        self.Fly_ScanDelta = delta
-        self.Fly_StartPos = start_angle
-        self.Fly_EndPos = end_angle
-        self.Fly_SlewSpeed = slew_speed
-        # Pause to let the values update
-        time.sleep(3)
+        # Set values for fly scan parameters, all sent at once and
+        # waited on together
+        with self.pv_update_event('Fly_Calc_Projections') as calc_updated:
+            with self.wait_pvs():
+                self.Fly_ScanControl = "Custom"
+                self.Fly_StartPos = start_angle
+                self.Fly_EndPos = end_angle
+                self.Fly_SlewSpeed = slew_speed
+            # The controller recalculates the number of triggers after
+            # each put, so only count updates from the last one
+            calc_updated.clear()
+            self.Fly_ScanDelta = delta
+            # Wait for the new value, with the old fixed pause as the
+            # upper limit. A value that already matches may not get
+            # posted again, so there is nothing to wait for.
+            calc_proj = self.Fly_Calc_Projections
+            if calc_proj is None or abs(calc_proj - num_projections) > 1:
+                if not calc_updated.wait(timeout=3):
+                    log.warning("Fly_Calc_Projections (%s) was not updated for "
+                                "%d projections, using it anyway",
+                                calc_proj, num_projections)
         # Update the value for the number of projections from instrument
         extra_projections = self.HDF1_NumCapture_RBV - num_projections
         log.debug('Acquiring %d extra projections (flat/dark)', extra_projections)
@@ -1165,12 +1386,14 @@ class NanoTXM(object):
             log.debug('Fly scan resetting num_projections to %d (%d)',
                       num_projections, extra_projections)
         # Logging
-        # Prepare the instrument for scanning
-        self.Reset_Theta = 1
-        self.Cam1_TriggerMode = 'Overlapped'
-        self.Cam1_NumImages = num_projections
-        self.HDF1_NumCapture = num_projections + extra_projections
-        self.Cam1_ImageMode = self.IMAGE_MODE_MULTIPLE
+        # Prepare the instrument for scanning, then arm the camera once
+        # all the settings have been accepted
+        with self.wait_pvs():
+            self.Reset_Theta = 1
+            self.Cam1_TriggerMode = 'Overlapped'
+            self.Cam1_NumImages = num_projections
+            self.HDF1_NumCapture = num_projections + extra_projections
+            self.Cam1_ImageMode = self.IMAGE_MODE_MULTIPLE
         self.Cam1_Acquire = self.DETECTOR_ACQUIRE
         self.wait_pv('Cam1_Status', self.DETECTOR_WAITING)
         # Execute the fly scan
@@ -1275,6 +1498,15 @@ class NanoTXM(object):
         formatter = logging.Formatter(
             '%(levelname)s:%(name)s:%(message)s (%(asctime)s)')
         handler.setFormatter(formatter)
+        if isinstance(handler, logging.FileHandler):
+            # Buffer the records so slow writes to the data directory
+            # don't hold up the scan. The buffer is kept small and
+            # warnings flush it, so the file can still be followed
+            # during the scan and little is lost if it gets killed
+            handler = logging.handlers.MemoryHandler(
+                capacity=self.LOG_BUFFER_SIZE, flushLevel=logging.WARNING,
+                target=handler)
+            handler.setLevel(int(level))
         root_log = logging.getLogger()
         root_log.addHandler(handler)
         # Make sure the root logger will actually emit the requested level
@@ -1348,10 +1580,17 @@ class NanoTXM(object):
             log.debug("Finished shutting down")
             # Restore original logging
             root_logger.setLevel(old_log_level)
-            # Remove any added logging handlers
-            for hndlr in root_logger.handlers:
+            # Remove any added logging handlers, writing out anything
+            # they have buffered
+            for hndlr in tuple(root_logger.handlers):
                 if hndlr not in old_handlers:
                     root_logger.removeHandler(hndlr)
+                    # MemoryHandler.close() flushes but leaves the
+                    # target's file open
+                    target = getattr(hndlr, 'target', None)
+                    hndlr.close()
+                    if target is not None:
+                        target.close()
     
     def reset_ccd(self):
         log.debug("Resetting CCD")
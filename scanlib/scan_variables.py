@@ -19,7 +19,7 @@ def parse_list_variable(raw_value, dtype=float):
     """
     if hasattr(raw_value, 'split'):
         # Process string separated by commas
-        out = [x for x in raw_value.split(',')]
+        out = raw_value.split(',')
     elif hasattr(raw_value, '__iter__'):
         # Process iterables
         out = raw_value
@@ -283,6 +283,8 @@ def init_general_PVs(global_PVs, variableDict):
         global_PVs['Motor_Sample_Top_Z'] = PV('32idcTXM:mcs:c1:m1.VAL')
         global_PVs['Motor_X_Tile'] = PV('32idc01:m33.VAL')
         global_PVs['Motor_Y_Tile'] = PV('32idc02:m15.VAL')
+        global_PVs['Motor_X_Tile_RBV'] = PV('32idc01:m33.RBV')
+        global_PVs['Motor_Y_Tile_RBV'] = PV('32idc02:m15.RBV')
     # Zone plate:
     global_PVs['zone_plate_x'] = PV('32idcTXM:mcs:c2:m2.VAL')
     global_PVs['zone_plate_y'] = PV('32idc01:m110.VAL')
@@ -380,6 +382,12 @@ def init_general_PVs(global_PVs, variableDict):
     global_PVs['Interlaced_Images_Per_Cycle_RBV'] = PV('32idcTXM:iFly:interlaceFlySub.VALF')
     global_PVs['Interlaced_Num_Sub_Cycles'] = PV('32idcTXM:iFly:interlaceFlySub.B')
     global_PVs['Interlaced_Num_Sub_Cycles_RBV'] = PV('32idcTXM:iFly:interlaceFlySub.VALG')
+    # The searches above all run at once, so wait for them here against
+    # one shared deadline instead of on each PV's first put/get
+    deadline = time.time() + 5.0
+    for pv in global_PVs.values():
+        if not pv.wait_for_connection(timeout=max(deadline - time.time(), 0.01)):
+            log.warning('PV not connected: %s', pv.pvname)
 
 
 def stop_scan(global_PVs, variableDict):
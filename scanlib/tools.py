@@ -10,6 +10,8 @@ TxmPV
 import logging
 import datetime as dt
 import os
+import signal
+import threading
 
 import epics
 import numpy as np
@@ -28,6 +30,27 @@ def loggingConfig(level=logging.INFO):
     logging.basicConfig(level=int(level), filename=os.path.join(path, filename))
 
 
+def start_sleep(seconds):
+    """Wait before a scan starts, returning early on Ctrl-C.
+    
+    Returns ``True`` if the full time passed, or ``False`` if the
+    wait was interrupted and the scan should not be started.
+    
+    """
+    abort = threading.Event()
+    try:
+        old_handler = signal.signal(signal.SIGINT, lambda *args: abort.set())
+    except ValueError:
+        # Signal handlers can only be set from the main thread
+        old_handler = None
+    try:
+        interrupted = abort.wait(timeout=max(seconds, 0))
+    finally:
+        if old_handler is not None:
+            signal.signal(signal.SIGINT, old_handler)
+    return not interrupted
+
+
 def expand_position(position, length=4):
     """Take a tuple with length <= 4 and pad it with ``None``'s up to
     length.
@@ -85,9 +108,18 @@ def energy_range(*ranges):
     
     Each entry in ``ranges`` should be a tuple of (start, stop,
     step). Unlike the standard ``range`` function, stop is
-    inclusive."""
-
-    Es = [np.arange(r[0], r[1]+r[2], r[2]) for r in ranges]
+    inclusive if it falls on a whole number of steps."""
+    Es = []
+    for start, stop, step in ranges:
+        # Count the points up front, so floating-point drift cannot
+        # add or drop the last point
+        n_steps = int(round((stop - start) / step))
+        if abs(start + n_steps * step - stop) > abs(step) * 1e-6:
+            # Stop is not on a step, so end on the last step before it
+            n_steps = int(np.floor((stop - start) / step))
+            stop = start + n_steps * step
+        E = np.linspace(start, stop, max(n_steps + 1, 0))
+        Es.append(E)
     Es = np.concatenate(Es)
     Es = np.unique(Es)
     return Es
@@ -16,6 +16,8 @@ __all__ = ['TxmPV', 'permit_required']
 
 import logging
 import warnings
+import threading
+import time
 
 from epics import PV as EpicsPV
 
@@ -71,24 +73,21 @@ class PVMonitor():
     overhead of constantly running epics.caget(). The value of
     ``latest_value`` is updated whenever the value changes.
 
-    A common pattern might be to use this within a while loop
-    alongside epics.poll() to test when a value has reached a desired
-    target.
+    A common pattern is to block until the value has reached a
+    desired target. The callback wakes the waiting thread, so there
+    is no polling loop.
 
     .. code:: python
 
         with PVMonitor(pv_name='my:awesome:motor') as mon:
-            while True:
-                if mon.latest_value = target_value:
-                    break
-                else:
-                    epics.poll()
+            mon.wait_for_value(target_value, timeout=5)
 
     """
     latest_value = None
     def __init__(self, pv_name):
         self.pv_name = pv_name
         self.pv = EpicsPV(self.pv_name)
+        self._changed = threading.Condition()
 
     def __enter__(self):
         self.start()
@@ -105,7 +104,29 @@ class PVMonitor():
         self.pv.remove_callback(self.callback_idx)
 
     def update_value(self, pvname, value, **kwargs):
-        self.latest_value = value
+        with self._changed:
+            self.latest_value = value
+            self._changed.notify_all()
+
+    def wait_for_value(self, target_val, timeout=-1):
+        """Block until ``latest_value`` equals ``target_val``.
+        
+        Negative ``timeout`` waits forever. Returns ``True`` if the
+        target was reached, or ``False`` if the wait timed out.
+        
+        """
+        deadline = None if timeout < 0 else time.time() + timeout
+        with self._changed:
+            while self.latest_value != target_val:
+                if deadline is None:
+                    # Wake up now and then so Ctrl-C still works
+                    self._changed.wait(1.)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._changed.wait(remaining)
+        return True
 
 
 class TxmPV(object):
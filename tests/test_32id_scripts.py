@@ -16,8 +16,11 @@ else:
     from unittest import mock
 import sys
 import os
+import shutil
+import tempfile
 
 import numpy as np
+import h5py
 
 from aps_32id.run import (energy_scan, move_energy, tomo_step_scan, tomo_fly_scan)
 from aps_32id.txm import NanoTXM
@@ -70,9 +73,11 @@ class TomoStepScanTests(ScriptTestCase):
         expected_projections = 361 + 2 + 7 + 13 + 21
         self.txm.setup_detector.assert_called_once_with(
             exposure=3,
-            num_projections=expected_projections)
+            num_projections=expected_projections,
+            live_display=True)
         self.txm.setup_hdf_writer.assert_called_once_with(
-            num_projections=expected_projections)
+            num_projections=expected_projections, compression=None,
+            tile_size=None, frames_per_chunk=1)
 
 
 class TomoFlyScanTests(unittest.TestCase):
@@ -93,23 +98,47 @@ class TomoFlyScanTests(unittest.TestCase):
             warnings.filterwarnings('ignore', message='Could not retrieve actual angles')
             warnings.filterwarnings('ignore', message='Collecting white field')
             txm = tomo_fly_scan.run_tomo_fly_scan(txm=self.txm, log_level=None)
+    
+    def test_num_projections(self):
+        # The HDF file itself is not needed here
+        self.txm.hdf_file = mock.MagicMock()
+        self.txm.Fly_Calc_Projections = 300
+        self.txm.Cam1_NumImages = 300
+        self.txm.HDF1_NumCapture_RBV = 343
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='Could not cast')
+            warnings.filterwarnings('ignore', message='Could not retrieve actual angles')
+            warnings.filterwarnings('ignore', message='Collecting white field')
+            tomo_fly_scan.run_tomo_fly_scan(
+                projections=300, num_white=(2, 7), num_dark=(13, 21),
+                txm=self.txm, log_level=None)
+        expected_projections = 300 + 2 + 7 + 13 + 21
+        self.txm.setup_detector.assert_called_with(
+            exposure=0.2, num_projections=expected_projections)
+        self.txm.setup_hdf_writer.assert_called_with(
+            num_projections=expected_projections, direct_chunk=True,
+            compression=None, swmr=False)
 
 
 class EnergyScanTests(unittest.TestCase):
     def setUp(self):
         self.txm = TXMStub(has_permit=True)
+        # The stub's mocks are shared by the class, so clear earlier calls
+        for stub_mock in (TXMStub.wait_pv, TXMStub.capture_projections,
+                          TXMStub.capture_dark_field, TXMStub.setup_hdf_writer,
+                          TXMStub.setup_detector, TXMStub.open_shutters):
+            stub_mock.reset_mock()
+        # Each test gets its own directory so parallel runs don't collide
+        self.tmpdir = tempfile.mkdtemp()
+        self.hdf_filename = os.path.join(self.tmpdir, 'test_file.h5')
     
     def tearDown(self):
         # Get rid of the temporary HDF5 file
-        if os.path.exists('/tmp/test_file.h5'):
-            os.remove('/tmp/test_file.h5')
+        shutil.rmtree(self.tmpdir)
     
     def test_start_scan(self, *args):
-        # Get rid of any old files hanging around
-        if os.path.exists('/tmp/test_file.h5'):
-            os.remove('/tmp/test_file.h5')
         # Set some sensible TXM values for testing
-        self.txm.HDF1_FullFileName_RBV = '/tmp/test_file.h5'
+        self.txm.HDF1_FullFileName_RBV = self.hdf_filename
         # Launch the script
         energies = np.linspace(8.6, 8.8, num=4)
         n_pre_dark = 4
@@ -128,6 +157,133 @@ class EnergyScanTests(unittest.TestCase):
         txm.capture_projections.assert_called_with()
         txm.capture_dark_field.assert_called_with(num_projections=4)
         # Verify the detector and hdf writer were colled properly
-        txm.setup_hdf_writer.assert_called_with(num_projections=expected_projections)
+        txm.setup_hdf_writer.assert_called_with(num_projections=expected_projections,
+                                                direct_chunk=True,
+                                                compression=None)
         txm.setup_detector.assert_called_with(exposure=0.77,
                                               num_projections=expected_projections)
+    
+    def test_capture_stopped_before_saving(self):
+        self.txm.HDF1_FullFileName_RBV = self.hdf_filename
+        energies = np.linspace(8.6, 8.8, num=2)
+        def run_scan(writer_drains):
+            self.txm.HDF1_Capture = 1
+            capture_states = []
+            def save_energies(txm, *args, **kwargs):
+                capture_states.append(txm.HDF1_Capture)
+            def wait_pv(pv_name, *args, **kwargs):
+                return writer_drains or pv_name != 'HDF1_Capture_RBV'
+            with warnings.catch_warnings(), \
+                 mock.patch.object(energy_scan, '_save_energies', save_energies), \
+                 mock.patch.object(self.txm, 'wait_pv', side_effect=wait_pv):
+                warnings.filterwarnings('ignore', message='Could not cast')
+                warnings.filterwarnings('ignore', message='Collecting white field with')
+                energy_scan.run_energy_scan(energies=energies, txm=self.txm,
+                                            log_level=None)
+            return capture_states
+        # The writer finishes its queued frames, so capture is left alone
+        self.assertEqual(run_scan(writer_drains=True), [1])
+        # Missing frames: the writer must be stopped before the file is opened
+        self.assertEqual(run_scan(writer_drains=False), [0])
+    
+    def test_wait_for_energy(self):
+        self.txm.HDF1_FullFileName_RBV = self.hdf_filename
+        energies = np.linspace(8.6, 8.8, num=2)
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='Could not cast')
+            warnings.filterwarnings('ignore', message='Could not save energies')
+            warnings.filterwarnings('ignore', message='Collecting white field with')
+            txm = energy_scan.run_energy_scan(energies=energies,
+                                              stabilize_sleep_ms=250,
+                                              wait_for_energy=True,
+                                              txm=self.txm, log_level=None)
+        # Check that the undulator busy flag was used for stabilizing,
+        # with the time spent moving the sample taken off the limit
+        energy_waits = [c for c in txm.wait_pv.call_args_list
+                        if c[0] == ('EnergyWait', 0)]
+        self.assertEqual(len(energy_waits), len(energies))
+        for c in energy_waits:
+            self.assertTrue(0 < c[1]['timeout'] <= 0.25)
+            self.assertTrue(c[1]['quiet'])
+    
+    def test_two_pass(self):
+        txm = self.txm
+        txm.capture_projections.reset_mock()
+        energies = np.linspace(8.6, 8.8, num=3)
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='Could not cast')
+            warnings.filterwarnings('ignore', message='Collecting white field with')
+            with mock.patch.object(txm, 'move_sample') as move_sample, \
+                 mock.patch.object(txm, 'move_energy') as move_energy, \
+                 mock.patch.object(txm, 'capture_white_field') as capture_white:
+                frames = energy_scan._capture_energy_passes(
+                    txm=txm, energies=energies, constant_mag=True,
+                    stabilize_sleep_ms=0, sample_pos=(0.,), out_pos=(0.2,),
+                    ZP_X_drift_array=np.zeros_like(energies))
+        # The sample only moves once per pass
+        self.assertEqual(move_sample.call_args_list,
+                         [mock.call(0.), mock.call(0.2)])
+        self.assertEqual(txm.capture_projections.call_count, 3)
+        self.assertEqual(capture_white.call_count, 3)
+        # Both passes go up in energy, with backlash correction at the
+        # start of each
+        moves = [(c[0][0], c[1]['correct_backlash'])
+                 for c in move_energy.call_args_list]
+        expected = [(E, i == 0) for i, E in enumerate(energies)]
+        self.assertEqual(moves, expected + expected)
+        self.assertEqual(frames,
+                         [(E, txm.FRAME_DATA) for E in energies] +
+                         [(E, txm.FRAME_WHITE) for E in energies])
+    
+    def test_move_zone_plate_x(self):
+        txm = mock.MagicMock()
+        # Already in place, so no move
+        txm.zone_plate_x = 0.50002
+        txm.zone_plate_x_RBV = 0.50002
+        energy_scan._move_zone_plate_x(txm, 0.5)
+        self.assertEqual(txm.zone_plate_x, 0.50002)
+        # Far enough away to move
+        energy_scan._move_zone_plate_x(txm, 0.51)
+        self.assertEqual(txm.zone_plate_x, 0.51)
+        # Setpoint matches but the motor stalled short of it
+        zone_plate_x = mock.PropertyMock(return_value=0.52)
+        type(txm).zone_plate_x = zone_plate_x
+        txm.zone_plate_x_RBV = 0.4
+        energy_scan._move_zone_plate_x(txm, 0.52)
+        zone_plate_x.assert_called_with(0.52)
+    
+    def test_save_energies(self):
+        energies = np.linspace(8.6, 8.8, num=3)
+        # Missing file should warn without waiting on the HDF writer
+        with mock.patch.object(self.txm, 'hdf_file') as hdf_file:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                energy_scan._save_energies(self.txm, self.hdf_filename,
+                                           energies, np.zeros_like(energies))
+                self.assertEqual(len(w), 1, 'Warning was not issued')
+            hdf_file.assert_not_called()
+        # Existing file gets the energies and drift
+        with h5py.File(self.hdf_filename, mode='w'):
+            pass
+        with mock.patch.object(self.txm, 'hdf_file',
+                               side_effect=lambda fname, mode: h5py.File(fname, mode)):
+            energy_scan._save_energies(self.txm, self.hdf_filename,
+                                       energies, np.zeros_like(energies),
+                                       frames=[(8.6, 0), (8.6, 2)])
+        with h5py.File(self.hdf_filename, mode='r') as hdf_f:
+            np.testing.assert_array_equal(hdf_f['/exchange/energy'], energies)
+            self.assertEqual(hdf_f['/exchange/zp_x_drift'].shape, (3,))
+            np.testing.assert_array_equal(hdf_f['/exchange/frame_energy'], [8.6, 8.6])
+            np.testing.assert_array_equal(hdf_f['/exchange/frame_type'], [0, 2])
+    
+    def test_in_background(self):
+        # Check that the function runs and errors reach the caller
+        results = []
+        join = energy_scan._in_background(results.append, 3)
+        join()
+        self.assertEqual(results, [3])
+        def fail():
+            raise ValueError('motor stalled')
+        join = energy_scan._in_background(fail)
+        with self.assertRaises(ValueError):
+            join()
@@ -1,12 +1,16 @@
 """Unit tests for the transmission x-ray microscope `TXM()` class."""
 
 import logging
+import logging.handlers
 logging.basicConfig(level=logging.WARNING)
 logging.captureWarnings(True)
 import os
+import shutil
+import tempfile
 from contextlib import contextmanager
 
 import six
+import threading
 import time
 import unittest
 if six.PY2:
@@ -122,6 +126,10 @@ class TXMUnitTests(unittest.TestCase):
         txm.pv_queue = []
         txm.pv_put('my_pv', 3, wait=True)
         self.assertEqual(len(txm.pv_queue), 1, "%d PV promises added to queue" % len(txm.pv_queue))
+        # Check that non-waiting PVs are not added to the queue
+        txm.pv_put('my_other_pv', 4, wait=False)
+        self.assertEqual(txm._test_value, 4)
+        self.assertEqual(len(txm.pv_queue), 1, "%d PV promises added to queue" % len(txm.pv_queue))
     
     def test_pv_put_twice(self):
         """Check what happens if two non-blocking calls to pv_put are made."""
@@ -138,6 +146,80 @@ class TXMUnitTests(unittest.TestCase):
         txm.pv_put('my_pv', 3, wait=True)
         self.assertEqual(len(txm.pv_queue), 1, "%d PV promises added to queue" % len(txm.pv_queue))
     
+    def test_wait_pvs(self):
+        """Check that wait_pvs blocks until the put callbacks fire."""
+        class StubTXM3(UnpluggedTXM):
+            def _pv_put(self, pv_name, value, callback=None, *args, **kwargs):
+                # Complete the put from another thread, like pyepics
+                timer = threading.Timer(0.1, callback)
+                timer.start()
+                return True
+        txm = StubTXM3()
+        txm.pv_queue = None
+        start = time.time()
+        with txm.wait_pvs():
+            txm.pv_put('my_pv', 3, wait=True)
+            txm.pv_put('my_other_pv', 4, wait=True)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertIsNone(txm.pv_queue)
+    
+    def test_wait_pvs_timeout(self):
+        """Check that wait_pvs gives up if a put callback never fires."""
+        class StubTXM4(UnpluggedTXM):
+            def _pv_put(self, pv_name, value, callback=None, *args, **kwargs):
+                return True
+        txm = StubTXM4()
+        txm.pv_queue = None
+        with self.assertRaises(exceptions_.TimeoutError):
+            with txm.wait_pvs(timeout=0.1):
+                txm.pv_put('my_pv', 3, wait=True)
+        self.assertIsNone(txm.pv_queue)
+    
+    def test_pv_queue_per_thread(self):
+        """Check that wait_pvs in one thread doesn't defer another
+        thread's puts."""
+        txm = UnpluggedTXM()
+        txm.pv_queue = None
+        queues = []
+        def background():
+            with txm.wait_pvs():
+                queues.append(txm.pv_queue)
+                txm.pv_put('my_other_pv', 4, wait=True)
+        thread = threading.Thread(target=background)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(queues[0]), 1)
+        self.assertIsNone(txm.pv_queue)
+        # Puts from another thread block instead of joining this queue
+        with txm.wait_pvs() as queue:
+            thread = threading.Thread(
+                target=lambda: txm.pv_put('my_pv', 3, wait=True))
+            thread.start()
+            thread.join()
+            self.assertEqual(len(queue), 0)
+    
+    def test_pv_reused(self):
+        """Check that PV objects come from pyepics' cache."""
+        txm = NanoTXM(has_permit=False)
+        with mock.patch.object(txm_module, 'get_pv') as get_pv:
+            txm.pv_get('my_pv')
+            txm._pv_put('my_pv', 3, wait=False)
+        self.assertEqual(get_pv.call_args_list,
+                         [mock.call('my_pv'), mock.call('my_pv')])
+        get_pv.return_value.put.assert_called_with(3, wait=False)
+    
+    def test_connect_pvs(self):
+        txm = NanoTXM(has_permit=False)
+        with mock.patch.object(txm_module, 'get_pv') as get_pv:
+            get_pv.return_value.wait_for_connection.return_value = False
+            get_pv.return_value.pvname = 'my_pv'
+            unconnected = txm.connect_pvs(timeout=0)
+        # Each PV is only searched for once
+        pv_names = [c[0][0] for c in get_pv.call_args_list]
+        self.assertIn('32idcTXM:nf:c0:m1.VAL', pv_names)
+        self.assertEqual(len(pv_names), len(set(pv_names)))
+        self.assertEqual(len(unconnected), len(pv_names))
+    
     def test_move_sample(self):
         txm = UnpluggedTXM()
         txm.Motor_SampleX = 0.
@@ -150,6 +232,14 @@ class TXMUnitTests(unittest.TestCase):
         self.assertEqual(txm.Motor_SampleY, 2)
         self.assertEqual(txm.Motor_Sample_Top_Z, 3)
         self.assertEqual(txm.Motor_SampleRot, 45)
+        # Check that x, y, z are moved together outside wait_pvs
+        txm.pv_queue = None
+        with mock.patch.object(txm, 'wait_pvs') as wait_pvs:
+            txm.move_sample(4, 5, 6)
+            txm.move_sample(theta=90)
+        wait_pvs.assert_called_once_with()
+        self.assertEqual(txm.Motor_Sample_Top_X, 4)
+        self.assertEqual(txm.Motor_Sample_Top_Z, 6)
     
     def test_move_energy(self):
         txm = UnpluggedTXM(has_permit=True)
@@ -222,6 +312,9 @@ class TXMUnitTests(unittest.TestCase):
         self.assertEqual(txm.Cam1_TriggerMode, "Ext. Standard")
         self.assertEqual(txm.Cam1_NumImages, 35)
         self.assertEqual(txm.Cam1_Acquire, txm.DETECTOR_ACQUIRE)
+        # Check that the live display can be turned off
+        txm.setup_detector(num_projections=35, live_display=False)
+        self.assertEqual(txm.Cam1_Display, False)
     
     def test_setup_hdf_writer(self):
         txm = UnpluggedTXM(has_permit=True)
@@ -235,6 +328,60 @@ class TXMUnitTests(unittest.TestCase):
         self.assertEqual(txm.HDF1_Capture, 1)
         self.assertTrue(txm.hdf_writer_ready)
     
+    def test_setup_hdf_writer_direct_chunk(self):
+        txm = UnpluggedTXM(has_permit=True)
+        txm.setup_hdf_writer(num_projections=3, direct_chunk=True)
+        # Check that frames are chunked one at a time
+        self.assertEqual(txm.HDF1_ChunkSizeAuto, 'Yes')
+        self.assertEqual(txm.HDF1_NumFramesChunks, 1)
+        self.assertEqual(txm.HDF1_NumCapture, 3)
+        # Check that SWMR mode can be turned on
+        txm.setup_hdf_writer(num_projections=3, swmr=True)
+        self.assertEqual(txm.HDF1_SWMRMode, 'On')
+        # ...and back off for the next scan
+        txm.setup_hdf_writer(num_projections=3)
+        self.assertEqual(txm.HDF1_SWMRMode, 'Off')
+        # Check that Blosc compression uses the LZ4 codec
+        txm.setup_hdf_writer(num_projections=3, compression='Blosc')
+        self.assertEqual(txm.HDF1_Compression, 'Blosc')
+        self.assertEqual(txm.HDF1_BloscCompressor, 'LZ4')
+        self.assertEqual(txm.HDF1_BloscShuffle, 'Byte')
+        # Check that frames can be split into tiles
+        txm.setup_hdf_writer(num_projections=3, tile_size=256)
+        self.assertEqual(txm.HDF1_ChunkSizeAuto, 'No')
+        self.assertEqual(txm.HDF1_NumRowChunks, 256)
+        self.assertEqual(txm.HDF1_NumColChunks, 256)
+        self.assertEqual(txm.HDF1_NumFramesChunks, 1)
+        # Check that the next scan goes back to whole frames
+        txm.setup_hdf_writer(num_projections=3)
+        self.assertEqual(txm.HDF1_ChunkSizeAuto, 'Yes')
+        txm.setup_hdf_writer(num_projections=3, tile_size=256)
+        # Check that chunks can span several frames
+        txm.setup_hdf_writer(num_projections=3, tile_size=256,
+                             frames_per_chunk=16)
+        self.assertEqual(txm.HDF1_NumFramesChunks, 16)
+        txm.setup_hdf_writer(num_projections=3)
+        self.assertEqual(txm.HDF1_ChunkSizeAuto, 'Yes')
+        self.assertEqual(txm.HDF1_NumFramesChunks, 1)
+        with self.assertRaises(ValueError):
+            txm.setup_hdf_writer(num_projections=3, direct_chunk=True,
+                                 tile_size=256)
+        with self.assertRaises(ValueError):
+            txm.setup_hdf_writer(num_projections=3, direct_chunk=True,
+                                 frames_per_chunk=16)
+    
+    def test_hdf_file_chunk_cache(self):
+        txm = UnpluggedTXM(has_permit=True)
+        hdf_filename = '/tmp/sector32_cache_test.h5'
+        try:
+            with txm.hdf_file(hdf_filename, mode='w', rdcc_nbytes=1024**2,
+                              rdcc_nslots=521, rdcc_w0=0.75) as hdf_f:
+                cache = hdf_f.id.get_access_plist().get_cache()
+            self.assertEqual(cache[1:], (521, 1024**2, 0.75))
+        finally:
+            if os.path.exists(hdf_filename):
+                os.remove(hdf_filename)
+    
     def test_setup_hdf_writer_recursive(self):
         txm = UnpluggedTXM(has_permit=True)
         txm.Proc1_ArrayPort = "test_value"
@@ -499,6 +646,31 @@ class TXMUnitTests(unittest.TestCase):
         self.assertEqual(txm.Reset_Theta, 1)
         self.assertEqual(txm.Cam1_TriggerMode, "Overlapped")
     
+    def test_flyscan_calc_projections(self):
+        """Check that only updates after the last fly-scan put count."""
+        txm = UnpluggedTXM(has_permit=True)
+        txm.exposure_time = 0.3
+        txm.Fly_Calc_Projections = 100 # Stale value from another scan
+        txm.HDF1_NumCapture_RBV = 390
+        calls = []
+        updated = mock.MagicMock()
+        updated.clear.side_effect = lambda: calls.append(list(txm._put_calls))
+        updated.wait.return_value = False
+        @contextmanager
+        def pv_update_event(pv_name):
+            yield updated
+        txm.pv_update_event = pv_update_event
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message="Could not retrieve actual angles")
+            with mock.patch('aps_32id.txm.log') as log:
+                txm.capture_tomogram_flyscan(0, 180, 360, ccd_readout=0.2)
+        self.assertTrue(log.warning.called)
+        # The event was cleared after every put but the last one
+        put_names = [name for name, val in calls[0]]
+        self.assertIn('32idcTXM:PSOFly3:slewSpeed', put_names)
+        self.assertNotIn('32idcTXM:PSOFly3:scanDelta', put_names)
+        updated.wait.assert_called_once_with(timeout=3)
+    
     def test_start_logging(self):
         # Prepare the test resources
         logfile = 'run_scan_test_file.log'
@@ -532,8 +704,12 @@ class TXMUnitTests(unittest.TestCase):
             root_logger.removeHandler(root_logger.handlers[-1])
             txm.HDF1_Capture_RBV = txm.HDF_WRITING
             txm.HDF1_FullFileName_RBV = 'run_scan_test_file.h5'
-            txm.start_logging(level=logging.DEBUG)
+            handler = txm.start_logging(level=logging.DEBUG)
             self.assertTrue(os.path.exists('run_scan_test_file.log'))
+            # Check that the file writes are buffered
+            self.assertIsInstance(handler, logging.handlers.MemoryHandler)
+            root_logger.removeHandler(handler)
+            handler.close()
         except:
             # Restore default logging levels
             root_logger.setLevel(old_root_level)
@@ -574,3 +750,24 @@ class TXMUnitTests(unittest.TestCase):
         # Check that the logging was restored
         self.assertEqual(root_logger.level, old_level)
         self.assertEqual(len(root_logger.handlers), num_handlers)
+    
+    def test_run_scan_closes_log_file(self):
+        txm = UnpluggedTXM(has_permit=True)
+        txm.zone_plate_x = 0
+        txm.zone_plate_y = 0
+        txm.zone_plate_z = 70
+        txm.move_sample(3., 4, 5, 90)
+        txm.move_energy(8.7)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        txm.HDF1_Capture_RBV = txm.HDF_WRITING
+        # The fake PV values are shared, so don't leave the writer running
+        self.addCleanup(setattr, txm, 'HDF1_Capture_RBV', txm.HDF_IDLE)
+        txm.HDF1_FullFileName_RBV = os.path.join(tmpdir, 'scan.h5')
+        with txm.run_scan():
+            handler = txm.start_logging(level=logging.CRITICAL)
+            file_handler = handler.target
+        # The buffered file handler and its file should both be closed
+        self.assertIsNone(file_handler.stream)
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'scan.log')))
+        self.assertNotIn(handler, logging.getLogger().handlers)
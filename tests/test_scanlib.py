@@ -4,10 +4,14 @@ import logging
 logging.basicConfig(level=logging.WARNING)
 import warnings
 import unittest
+import os
+import signal
+import threading
+import time
 
 import numpy as np
 
-from scanlib.tools import energy_range, energy_range_from_points
+from scanlib.tools import energy_range, energy_range_from_points, start_sleep
 from scanlib.scan_variables import parse_list_variable
 
 log = logging.getLogger(__name__)
@@ -28,6 +32,30 @@ class ToolsTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             energy_range_from_points(energy_points=points,
                                      energy_steps=steps)
+    
+    def test_energy_range_inclusive(self):
+        # Floating-point steps should give exactly one point per step
+        output = energy_range((8.3, 8.7, 0.1))
+        self.assertEqual(len(output), 5)
+        self.assertEqual(output[-1], 8.7)
+        # Shared end points between ranges are not duplicated
+        output = energy_range((8.3, 8.5, 0.02), (8.5, 8.7, 0.01))
+        self.assertEqual(len(output), 31)
+        # The step is kept even if it doesn't divide the range
+        output = energy_range((8.3, 8.75, 0.1))
+        np.testing.assert_allclose(output, [8.3, 8.4, 8.5, 8.6, 8.7])
+    
+    def test_start_sleep(self):
+        old_handler = signal.getsignal(signal.SIGINT)
+        self.assertTrue(start_sleep(0))
+        # Ctrl-C ends the sleep early without raising KeyboardInterrupt
+        timer = threading.Timer(0.1, os.kill, args=(os.getpid(), signal.SIGINT))
+        timer.start()
+        start = time.time()
+        self.assertFalse(start_sleep(10))
+        self.assertLess(time.time() - start, 5)
+        # The original handler is back in place
+        self.assertIs(signal.getsignal(signal.SIGINT), old_handler)
 
 
 class ScanVariableTestCase(unittest.TestCase):
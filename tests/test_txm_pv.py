@@ -3,6 +3,7 @@
 import logging
 logging.basicConfig(level=logging.WARNING)
 import warnings
+import threading
 import six
 import unittest
 if six.PY2:
@@ -12,7 +13,7 @@ else:
 
 from epics import PV as EpicsPV, get_pv
 
-from scanlib.txm_pv import TxmPV
+from scanlib.txm_pv import TxmPV, PVMonitor
 
 
 log = logging.getLogger(__name__)
@@ -96,3 +97,17 @@ class PVDescriptorTestCase(unittest.TestCase):
                       '`as_string` parameter not passed to pv_get')
         self.assertNotIn('as_string', txm._put_kwargs['string_pv'].keys(),
                          '`as_string` parameter passed to _pv_put')
+
+
+class PVMonitorTestCase(unittest.TestCase):
+    
+    def test_wait_for_value(self):
+        with mock.patch('scanlib.txm_pv.EpicsPV'):
+            mon = PVMonitor('my_pv')
+        # Nothing updates the value, so the wait times out
+        self.assertFalse(mon.wait_for_value(3, timeout=0.05))
+        # A callback from another thread ends the wait
+        timer = threading.Timer(0.05, mon.update_value,
+                                kwargs=dict(pvname='my_pv', value=3))
+        timer.start()
+        self.assertTrue(mon.wait_for_value(3, timeout=5))
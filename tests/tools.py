@@ -1,3 +1,6 @@
+import threading
+from contextlib import contextmanager
+
 import six
 if six.PY2:
     import mock
@@ -31,6 +34,13 @@ class UnpluggedTXM(NanoTXM):
     def wait_pv(self, *args, **kwargs):
             return True
     
+    @contextmanager
+    def pv_update_event(self, pv_name):
+        # Nothing is connected, so pretend the PV always updates right away
+        updated = mock.MagicMock(spec=threading.Event)
+        updated.wait.return_value = True
+        yield updated
+    
     def _pv_put(self, pv_name, value, callback=None, *args, **kwargs):
         self._put_calls.append((pv_name, value))
         self._pv_dict[pv_name] = value